@@ -0,0 +1,527 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Offline benchmark for the local proxy server and the proxy verifier
+
+Everything runs on this machine, no network needed:
+
+- a stand-in origin serves verify_url and fixed size bodies
+- a stand-in upstream proxy speaks HTTP and SOCKS5 on one port, with
+  configurable latency and failure rate
+- the local proxy server under test runs in its own process, so its CPU
+  time and memory can be read from /proc
+- concurrent GET, POST and CONNECT clients drive it and report throughput
+  and p50/p99 latency
+- verification sweeps run over synthetic pools spread across 127.x.y.z
+  addresses, some alive, some silent and the rest refusing connections
+
+Example:
+    ./benchmark.py --server-mode both --requests 5000 --concurrency 100
+    ./benchmark.py --scenarios '' --sweep 1000,10000,100000
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import socket
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import proxy_anonymizer as pa
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def is_loopback(writer: asyncio.StreamWriter) -> bool:
+    peer = writer.get_extra_info('peername')
+    return bool(peer) and peer[0].startswith('127.')
+
+def percentile(samples: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of sorted samples"""
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+def process_usage(pid: int) -> Tuple[float, float, float]:
+    """CPU seconds, current RSS and peak RSS in MB of a process, read from /proc"""
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    rss = peak = 0.0
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                rss = int(line.split()[1]) / 1024
+            elif line.startswith('VmHWM:'):
+                peak = int(line.split()[1]) / 1024
+    return cpu, rss, peak
+
+class StandIns:
+    """Origin, upstream proxy and echo server the benchmark talks to instead of the internet"""
+
+    IP_BODY = b'203.0.113.7\n'
+
+    def __init__(self, latency: float = 0.0, failure_rate: float = 0.0, seed: int = 1):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.tasks = set()
+
+    async def delay(self) -> bool:
+        """Wait the configured latency, False when this exchange should fail instead"""
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self.random.random() >= self.failure_rate
+
+    @staticmethod
+    async def read_body(reader: asyncio.StreamReader, headers: List[Tuple[str, str]]) -> bytes:
+        length = next((int(value) for name, value in headers if name.lower() == 'content-length'), 0)
+        return await reader.readexactly(length) if length else b''
+
+    async def origin(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """GET /ip answers like verify_url, GET /bytes/N sends N bytes, POST /echo counts the body"""
+        try:
+            while True:
+                try:
+                    request_line, headers = await pa.AsyncProxyServer.read_head(reader)
+                except asyncio.IncompleteReadError:
+                    return
+                method, target, _ = request_line.split(' ', 2)
+                body = await self.read_body(reader, headers)
+                path = pa.urlparse(target).path
+                if method == 'POST':
+                    payload = b'%d\n' % len(body)
+                elif path.startswith('/bytes/'):
+                    payload = b'x' * int(path[len('/bytes/'):])
+                else:
+                    payload = self.IP_BODY
+                close = any(name.lower() == 'connection' and value.lower() == 'close' for name, value in headers)
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nContent-Length: %d\r\n%s\r\n'
+                             % (len(payload), b'Connection: close\r\n' if close else b''))
+                writer.write(payload)
+                await writer.drain()
+                if close:
+                    return
+        except (OSError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def upstream(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Stand-in proxy: SOCKS5 when the client opens with 0x05, HTTP otherwise
+
+        It only ever connects to stand-ins on the loopback, so listening on
+        all addresses for the sweep does not make it an open proxy.
+        """
+        if not is_loopback(writer):
+            writer.close()
+            return
+        target_writer = None
+        try:
+            first = await reader.readexactly(1)
+            if first == b'\x05':
+                host, port = await pa.run_handshake_async(pa.socks5_server_handshake(), reader, writer)
+                if not host.startswith('127.') or not await self.delay():
+                    writer.write(pa.socks5_reply(1))
+                    return
+                target_reader, target_writer = await asyncio.open_connection('127.0.0.1', port)
+                writer.write(pa.socks5_reply(0))
+                await self.pipe(reader, writer, target_reader, target_writer)
+                return
+            prefix = first
+            while True:
+                request_line, headers = await pa.AsyncProxyServer.read_head(reader, prefix)
+                prefix = b''
+                method, target, _ = request_line.split(' ', 2)
+                if not await self.delay():
+                    return
+                if method == 'CONNECT':
+                    _, port = pa.split_host_port(target)
+                    target_reader, target_writer = await asyncio.open_connection('127.0.0.1', port)
+                    writer.write(b'HTTP/1.1 200 Connection established\r\n\r\n')
+                    await self.pipe(reader, writer, target_reader, target_writer)
+                    return
+                if not await self.forward(reader, writer, method, target, headers):
+                    return
+        except (OSError, ValueError, IndexError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            if target_writer:
+                target_writer.close()
+            writer.close()
+
+    async def forward(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, method: str,
+                      target: str, headers: List[Tuple[str, str]]) -> bool:
+        """Relay one plain HTTP request to the origin, True if the client connection stays open"""
+        url = pa.urlparse(target)
+        body = await self.read_body(reader, headers)
+        origin_reader, origin_writer = await asyncio.open_connection('127.0.0.1', url.port or 80)
+        try:
+            path = url.path or '/'
+            origin_writer.write(f"{method} {path} HTTP/1.1\r\nHost: {url.netloc}\r\n"
+                                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            status_line, response_headers = await pa.AsyncProxyServer.read_head(origin_reader)
+            payload = await self.read_body(origin_reader, response_headers)
+        finally:
+            origin_writer.close()
+        close = any(name.lower() in ('connection', 'proxy-connection') and value.lower() == 'close'
+                    for name, value in headers)
+        writer.write(f"{status_line}\r\nContent-Length: {len(payload)}\r\n".encode()
+                     + (b'Connection: close\r\n' if close else b'') + b'\r\n' + payload)
+        await writer.drain()
+        return not close
+
+    @staticmethod
+    async def pipe(reader, writer, target_reader, target_writer) -> None:
+        upload = asyncio.ensure_future(pa.AsyncProxyServer.relay(reader, target_writer))
+        try:
+            await pa.AsyncProxyServer.relay(target_reader, writer)
+            await upload
+        finally:
+            await pa.cancel_tasks([upload])
+
+    @staticmethod
+    async def echo(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        await pa.AsyncProxyServer.relay(reader, writer)
+        writer.close()
+
+    @staticmethod
+    async def silent(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Accept and never answer, like a proxy that passes the TCP check and then hangs"""
+        if not is_loopback(writer):
+            writer.close()
+            return
+        try:
+            await reader.read()
+        except OSError:
+            pass
+        writer.close()
+
+    def held(self, handler):
+        """Keep a reference to every connection task, asyncio only holds weak ones"""
+        async def run(reader, writer):
+            task = asyncio.current_task()
+            self.tasks.add(task)
+            try:
+                await handler(reader, writer)
+            finally:
+                self.tasks.discard(task)
+        return run
+
+    async def serve(self, conn) -> None:
+        servers = [
+            await asyncio.start_server(self.held(handler), address, 0, limit=pa.RELAY_CHUNK_SIZE, backlog=4096)
+            for handler, address in (
+                (self.origin, '127.0.0.1'),
+                (self.upstream, '127.0.0.1'),
+                (self.echo, '127.0.0.1'),
+                # Swept proxies sit on many 127.x.y.z addresses, which only a wildcard
+                # bind can answer; non-loopback peers are turned away
+                (self.upstream, '0.0.0.0'),
+                (self.silent, '0.0.0.0'),
+            )
+        ]
+        conn.send([server.sockets[0].getsockname()[1] for server in servers])
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, conn.recv)
+
+def run_stand_ins(conn, latency: float, failure_rate: float, seed: int) -> None:
+    pa.raise_open_files_limit()
+    asyncio.run(StandIns(latency, failure_rate, seed).serve(conn))
+
+def run_server(conn, mode: str, port: int, upstream_url: str, max_connections: int) -> None:
+    """Serve the local proxy the way ProxyAnonymizer.start_local_proxy_server does"""
+    pa.raise_open_files_limit()
+    scheme, address = upstream_url.split('://', 1)
+    host, upstream_port = address.rsplit(':', 1)
+    proxy = pa.ProxyRecord(scheme, host, upstream_port)
+    sessions = pa.UpstreamSessionPool()
+    switch = pa.UpstreamSwitch(sessions)
+    switch.swap(proxy, {'http': proxy.url, 'https': proxy.url})
+    if mode == 'asyncio':
+        server = pa.AsyncProxyServer(port, switch, max_connections=max_connections)
+    else:
+        server = pa.ThreadedHTTPServer(
+            ('127.0.0.1', port),
+            lambda *args, **kwargs: pa.ProxyHandler(*args, upstreams=switch, sessions=sessions, **kwargs)
+        )
+        server.socks_handler = lambda *args, **kwargs: pa.SocksHandler(*args, upstreams=switch, **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    conn.send(port)
+    conn.recv()
+    server.shutdown()
+
+async def wait_for_port(port: int, timeout: float = 10) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.02)
+
+async def read_response(reader: asyncio.StreamReader) -> Tuple[int, bool]:
+    """Read one response, returns the status and whether the connection can be reused"""
+    status_line, headers = await pa.AsyncProxyServer.read_head(reader)
+    status = int(status_line.split(' ', 2)[1])
+    fields = {name.lower(): value.lower() for name, value in headers}
+    if 'chunked' in fields.get('transfer-encoding', ''):
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    elif 'content-length' in fields:
+        await reader.readexactly(int(fields['content-length']))
+    else:
+        await reader.read()
+        return status, False
+    return status, fields.get('connection') != 'close'
+
+class LoadGenerator:
+    """Concurrent clients of the local proxy, each keeping its connection alive when allowed"""
+
+    def __init__(self, proxy_port: int, origin_port: int, echo_port: int, size: int, tunnel_bytes: int):
+        self.proxy_port = proxy_port
+        self.origin_port = origin_port
+        self.echo_port = echo_port
+        self.size = size
+        self.tunnel_bytes = tunnel_bytes
+
+    async def http(self, method: str, connection) -> Tuple[bool, Optional[Tuple]]:
+        """One GET or POST through the proxy, reusing `connection` if given"""
+        if connection is None:
+            connection = await asyncio.open_connection('127.0.0.1', self.proxy_port, limit=pa.RELAY_CHUNK_SIZE)
+        reader, writer = connection
+        if method == 'GET':
+            head = f"GET http://127.0.0.1:{self.origin_port}/bytes/{self.size} HTTP/1.1\r\n"
+            body = b''
+        else:
+            head = f"POST http://127.0.0.1:{self.origin_port}/echo HTTP/1.1\r\n"
+            body = b'y' * self.size
+        head += (f"Host: 127.0.0.1:{self.origin_port}\r\nContent-Type: application/octet-stream\r\n"
+                 f"Content-Length: {len(body)}\r\n\r\n")
+        writer.write(head.encode() + body)
+        status, reusable = await read_response(reader)
+        if not reusable:
+            writer.close()
+            connection = None
+        return status == 200, connection
+
+    async def connect(self, connection=None) -> Tuple[bool, None]:
+        """Open a CONNECT tunnel to the echo server and bounce tunnel_bytes through it"""
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.proxy_port, limit=pa.RELAY_CHUNK_SIZE)
+        try:
+            writer.write(f"CONNECT 127.0.0.1:{self.echo_port} HTTP/1.1\r\n"
+                         f"Host: 127.0.0.1:{self.echo_port}\r\n\r\n".encode())
+            status_line, _ = await pa.AsyncProxyServer.read_head(reader)
+            if ' 200 ' not in status_line + ' ':
+                return False, None
+            payload = b'z' * self.tunnel_bytes
+            writer.write(payload)
+            await writer.drain()
+            received = 0
+            while received < len(payload):
+                data = await reader.read(pa.RELAY_CHUNK_SIZE)
+                if not data:
+                    return False, None
+                received += len(data)
+            return True, None
+        finally:
+            writer.close()
+
+    async def run(self, scenario: str, requests: int, concurrency: int, timeout: float = 30) -> Dict:
+        remaining = requests
+        latencies: List[float] = []
+        errors = 0
+
+        async def worker():
+            nonlocal remaining, errors
+            connection = None
+            while remaining > 0:
+                remaining -= 1
+                started = time.monotonic()
+                try:
+                    if scenario == 'connect':
+                        ok, connection = await asyncio.wait_for(self.connect(), timeout)
+                    else:
+                        ok, connection = await asyncio.wait_for(self.http(scenario.upper(), connection), timeout)
+                except (OSError, ValueError, IndexError, asyncio.TimeoutError,
+                        asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                    ok, connection = False, None
+                if ok:
+                    latencies.append(time.monotonic() - started)
+                else:
+                    errors += 1
+                    if connection:
+                        connection[1].close()
+                        connection = None
+            if connection:
+                connection[1].close()
+
+        started = time.monotonic()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.monotonic() - started
+        latencies.sort()
+        per_request = self.tunnel_bytes * 2 if scenario == 'connect' else self.size
+        return {
+            'ok': len(latencies),
+            'errors': errors,
+            'seconds': elapsed,
+            'requests_per_second': len(latencies) / elapsed,
+            'megabytes_per_second': len(latencies) * per_request / elapsed / 1e6,
+            'p50_ms': percentile(latencies, 0.50) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+        }
+
+def synthetic_pool(size: int, alive: float, silent: float, ports: Tuple[int, int, int],
+                   proxy_type: str, seed: int) -> List[pa.ProxyRecord]:
+    """Proxies on distinct 127.x.y.z addresses: working, hanging and refusing in the given shares"""
+    alive_port, silent_port, dead_port = ports
+    rng = random.Random(seed)
+    kinds = [alive_port] * int(size * alive) + [silent_port] * int(size * silent)
+    kinds += [dead_port] * (size - len(kinds))
+    rng.shuffle(kinds)
+    proxies = []
+    for i, port in enumerate(kinds):
+        rest, last = divmod(i, 254)
+        host = f"127.{rest // 256 + 1}.{rest % 256}.{last + 1}"
+        proxies.append(pa.ProxyRecord(proxy_type, host, port))
+    return proxies
+
+def run_sweep(size: int, args: argparse.Namespace, ports: Tuple[int, int, int], verify_url: str) -> Dict:
+    proxies = synthetic_pool(size, args.sweep_alive, args.sweep_silent, ports, args.sweep_type, args.seed)
+    verifier = pa.AsyncProxyVerifier(verify_url, concurrency=args.verify_concurrency,
+                                      timeout=args.verify_timeout, connect_timeout=args.verify_timeout)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    started = time.monotonic()
+    working = verifier.run(proxies)
+    elapsed = time.monotonic() - started
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    return {
+        'proxies': size,
+        'working': len(working),
+        'expected_working': int(size * args.sweep_alive),
+        'seconds': elapsed,
+        'checks_per_second': verifier.checked / elapsed,
+        'cpu_seconds': (after.ru_utime - usage.ru_utime) + (after.ru_stime - usage.ru_stime),
+        'peak_rss_mb': after.ru_maxrss / 1024,
+        'concurrency': verifier.concurrency,
+    }
+
+def benchmark_server(mode: str, args: argparse.Namespace, ports: List[int]) -> Dict[str, Dict]:
+    origin_port, upstream_port, echo_port = ports[:3]
+    scheme = 'socks5' if args.upstream == 'socks5' else 'http'
+    parent, child = multiprocessing.Pipe()
+    server = multiprocessing.Process(
+        target=run_server,
+        args=(child, mode, free_port(), f"{scheme}://127.0.0.1:{upstream_port}", args.concurrency * 4),
+        daemon=True
+    )
+    server.start()
+    proxy_port = parent.recv()
+    asyncio.run(wait_for_port(proxy_port))
+    load = LoadGenerator(proxy_port, origin_port, echo_port, args.size, args.tunnel_bytes)
+    results = {}
+    try:
+        for scenario in args.scenarios:
+            cpu_before = process_usage(server.pid)[0]
+            result = asyncio.run(load.run(scenario, args.requests, args.concurrency))
+            cpu, rss, peak = process_usage(server.pid)
+            result.update(server_cpu_seconds=cpu - cpu_before, server_rss_mb=rss, server_peak_rss_mb=peak)
+            results[scenario] = result
+    finally:
+        parent.send('stop')
+        server.join(5)
+        if server.is_alive():
+            server.terminate()
+    return results
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Offline benchmark of the local proxy and the verifier")
+    parser.add_argument('--server-mode', choices=('threaded', 'asyncio', 'both'), default='both')
+    parser.add_argument('--upstream', choices=('http', 'socks5'), default='http', help="stand-in upstream protocol")
+    parser.add_argument('--scenarios', default='get,post,connect', help="comma separated: get, post, connect")
+    parser.add_argument('--requests', type=int, default=2000, help="requests per scenario")
+    parser.add_argument('--concurrency', type=int, default=50, help="concurrent clients")
+    parser.add_argument('--size', type=int, default=16 * 1024, help="GET response and POST body bytes")
+    parser.add_argument('--tunnel-bytes', type=int, default=64 * 1024, help="bytes echoed through each tunnel")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds the upstream waits per request")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="share of upstream requests that fail")
+    parser.add_argument('--sweep', default='1000,10000', help="comma separated pool sizes to verify, '' to skip")
+    parser.add_argument('--sweep-alive', type=float, default=0.2, help="share of working proxies in a pool")
+    parser.add_argument('--sweep-silent', type=float, default=0.0, help="share that accepts but never answers")
+    parser.add_argument('--sweep-type', choices=('http', 'socks5'), default='http')
+    parser.add_argument('--verify-concurrency', type=int, default=500)
+    parser.add_argument('--verify-timeout', type=float, default=2.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args(argv)
+    args.scenarios = [name for name in args.scenarios.split(',') if name]
+    for name in args.scenarios:
+        if name not in ('get', 'post', 'connect'):
+            parser.error(f"unknown scenario: {name}")
+    args.sweep = [int(size) for size in args.sweep.split(',') if size]
+    return args
+
+def main() -> None:
+    args = parse_args()
+    pa.raise_open_files_limit()
+    # The handlers log failed upstream exchanges, keep them out of the report
+    logging.getLogger().setLevel(logging.WARNING)
+
+    parent, child = multiprocessing.Pipe()
+    stand_ins = multiprocessing.Process(target=run_stand_ins, args=(child, args.latency, args.failure_rate, args.seed),
+                                        daemon=True)
+    stand_ins.start()
+    ports = parent.recv()
+    results = {'settings': {key: value for key, value in vars(args).items() if key != 'json'}}
+
+    try:
+        modes = ('threaded', 'asyncio') if args.server_mode == 'both' else (args.server_mode,)
+        if args.scenarios:
+            print(f"{'server':<9} {'scenario':<8} {'ok':>7} {'errors':>6} {'req/s':>9} {'MB/s':>8} "
+                  f"{'p50 ms':>8} {'p99 ms':>8} {'cpu s':>7} {'rss MB':>7}")
+        for mode in modes:
+            if not args.scenarios:
+                break
+            results[mode] = benchmark_server(mode, args, ports)
+            for scenario, r in results[mode].items():
+                print(f"{mode:<9} {scenario:<8} {r['ok']:>7} {r['errors']:>6} {r['requests_per_second']:>9.0f} "
+                      f"{r['megabytes_per_second']:>8.1f} {r['p50_ms']:>8.2f} {r['p99_ms']:>8.2f} "
+                      f"{r['server_cpu_seconds']:>7.2f} {r['server_peak_rss_mb']:>7.1f}")
+
+        if args.sweep:
+            print(f"\n{'proxies':>8} {'working':>8} {'seconds':>8} {'checks/s':>9} {'cpu s':>7} {'rss MB':>7}")
+            verify_url = f"http://127.0.0.1:{ports[0]}/ip"
+            sweep_ports = (ports[3], ports[4], free_port())
+            results['sweeps'] = []
+            for size in args.sweep:
+                r = run_sweep(size, args, sweep_ports, verify_url)
+                results['sweeps'].append(r)
+                print(f"{r['proxies']:>8} {r['working']:>8} {r['seconds']:>8.2f} {r['checks_per_second']:>9.0f} "
+                      f"{r['cpu_seconds']:>7.2f} {r['peak_rss_mb']:>7.1f}")
+    finally:
+        parent.send('stop')
+        stand_ins.join(5)
+        if stand_ins.is_alive():
+            stand_ins.terminate()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=4)
+
+if __name__ == "__main__":
+    main()
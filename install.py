@@ -32,11 +32,11 @@ def install_dependencies():
     os_type = detect_os()
     try:
         if os_type == "arch":
-            subprocess.check_call('sudo pacman -Sy --noconfirm python python-pip tor gnu-netcat', shell=True)
+            subprocess.check_call('sudo pacman -Sy --noconfirm python python-pip tor', shell=True)
         elif os_type == "debian":
-            subprocess.check_call('sudo apt update && sudo apt install -y python3 python3-pip tor netcat', shell=True)
+            subprocess.check_call('sudo apt update && sudo apt install -y python3 python3-pip tor', shell=True)
         elif os_type == "rhel":
-            subprocess.check_call('sudo dnf install -y python3 python3-pip tor nmap-ncat', shell=True)
+            subprocess.check_call('sudo dnf install -y python3 python3-pip tor', shell=True)
         else:
             print("Unsupported OS. Please install dependencies manually.")
             sys.exit(1)
@@ -57,7 +57,8 @@ def install_python_packages():
                             arch_pkg = {
                                 'requests': 'python-requests',
                                 'beautifulsoup4': 'python-beautifulsoup4',
-                                'distro': 'python-distro'
+                                'distro': 'python-distro',
+                                'PySocks': 'python-pysocks'
                             }.get(pkg_name, f'python-{pkg_name}')
                             
                             try:
@@ -69,7 +70,7 @@ def install_python_packages():
             except Exception as e:
                 print(f"Failed to install Python packages: {e}")
                 print("\nPlease install the required packages manually:")
-                print("sudo pacman -S python-requests python-beautifulsoup4 python-distro")
+                print("sudo pacman -S python-requests python-beautifulsoup4 python-distro python-pysocks")
                 sys.exit(1)
         else:
             pip_cmd = [sys.executable, '-m', 'pip']
@@ -91,7 +92,7 @@ def install_python_packages():
         print(f"Failed to install Python packages: {e}")
         if os_type == "arch":
             print("\nPlease install the required packages manually:")
-            print("sudo pacman -S python-requests python-beautifulsoup4 python-distro")
+            print("sudo pacman -S python-requests python-beautifulsoup4 python-distro python-pysocks")
         else:
             print("\nPlease install the required packages manually:")
             print("python -m pip install -r requirements.txt")
@@ -5,22 +5,34 @@ import time
 import os
 import subprocess
 import sys
+import shutil
+import importlib.util
 import requests
 import random
 import json
-from typing import Optional, Dict, List
+from typing import Any, Awaitable, Optional, Dict, List, Callable, Iterable, Tuple
 import logging
 from pathlib import Path
-from bs4 import BeautifulSoup
 import concurrent.futures
+import contextlib
 from urllib.parse import urlparse
 import socketserver
 import http.server
 import threading
 import socket
-import select
+import selectors
+import errno
+import hashlib
+import hmac
+import heapq
+import bisect
+import sqlite3
+import re
+import fcntl
 import platform
-import distro
+import asyncio
+import argparse
+import signal
 
 # Configure logging
 logging.basicConfig(
@@ -32,156 +44,2848 @@ logging.basicConfig(
     ]
 )
 
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+
 def clear_screen():
     """Clear the terminal screen"""
     os.system('clear' if os.name == 'posix' else 'cls')
 
+def countdown(seconds: int, label: str, interrupt: Optional[threading.Event] = None) -> None:
+    """Sleep while counting the seconds down on one terminal line, until `interrupt` is set"""
+    for i in range(seconds, 0, -1):
+        print(f"\r{label}: {i} seconds", end="")
+        if interrupt:
+            if interrupt.wait(1):
+                break
+        else:
+            time.sleep(1)
+    print()
+
+# Headers that describe a single connection and must not be relayed
+HOP_BY_HOP_HEADERS = {
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'proxy-connection', 'te', 'trailers', 'transfer-encoding', 'upgrade'
+}
+RELAY_CHUNK_SIZE = 64 * 1024  # Bytes held in memory per relayed body read
+SPLICE_PIPE_SIZE = 1024 * 1024  # Kernel pipe size used by zero-copy tunnels
+
+# URL scheme for each proxy type: SOCKS proxies resolve the destination name
+# on the proxy side, and "https" proxies (as listed by sslproxies and the like)
+# are plain HTTP proxies that support CONNECT, not proxies spoken to over TLS
+PROXY_URL_SCHEMES = {'socks5': 'socks5h', 'socks4': 'socks4a', 'https': 'http'}
+# One int object per port number, shared by every proxy record on that port
+PORT_NUMBERS: Dict[int, int] = {}
+SOCKS_SCHEMES = {'socks4', 'socks4a', 'socks5', 'socks5h'}
+SOCKS5_ERRORS = {
+    1: "general failure",
+    2: "connection not allowed by ruleset",
+    3: "network unreachable",
+    4: "host unreachable",
+    5: "connection refused",
+    6: "TTL expired",
+    7: "command not supported",
+    8: "address type not supported"
+}
+
+class Metrics:
+    """Counters, gauges and histograms exported in the Prometheus text format
+
+    Every thread records into its own shard, so recording takes no lock and
+    only a thread's first record registers its shard. A scrape adds up the
+    shards; shards of finished threads are folded into one total.
+    """
+
+    # Upper bounds in seconds, good for both round trips and tunnel lifetimes
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+    # Registered shards before those of finished threads are folded
+    max_shards = 64
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.shards: List[Tuple[threading.Thread, Dict]] = []
+        self.retired: Dict = {}
+        # name -> (type, help, label names, buckets)
+        self.metrics: Dict[str, Tuple[str, str, Tuple[str, ...], Tuple[float, ...]]] = {}
+
+    def describe(self, name: str, kind: str, help: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        self.metrics[name] = (kind, help, labels, buckets)
+
+    def shard(self) -> Dict:
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = {}
+            with self.lock:
+                if len(self.shards) >= self.max_shards:
+                    self.fold()
+                self.shards.append((threading.current_thread(), shard))
+            return shard
+
+    def add(self, name: str, value: float = 1, labels: Tuple[str, ...] = ()) -> None:
+        """Add to a counter, or to a gauge when `value` may be negative"""
+        shard = self.shard()
+        key = (name, labels)
+        shard[key] = shard.get(key, 0) + value
+
+    def observe(self, name: str, value: float, labels: Tuple[str, ...] = ()) -> None:
+        """Record one histogram sample"""
+        shard = self.shard()
+        key = (name, labels)
+        buckets = self.metrics[name][3]
+        counts = shard.get(key)
+        if counts is None:
+            # One count per bucket plus +Inf, then the sum of all samples
+            counts = shard[key] = [0] * (len(buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(buckets, value)] += 1
+        counts[-1] += value
+
+    @staticmethod
+    def merge(total: Dict, shard: Dict) -> None:
+        for key, value in shard.items():
+            if isinstance(value, list):
+                counts = total.setdefault(key, [0] * len(value))
+                for i, count in enumerate(value):
+                    counts[i] += count
+            else:
+                total[key] = total.get(key, 0) + value
+
+    def fold(self) -> None:
+        """Move the shards of finished threads into the retired total, called with the lock held"""
+        alive = []
+        for thread, shard in self.shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                self.merge(self.retired, shard)
+        self.shards = alive
+
+    def snapshot(self) -> Dict:
+        with self.lock:
+            self.fold()
+            total: Dict = {}
+            self.merge(total, self.retired)
+            for _, shard in self.shards:
+                # Copying a dict is atomic under the GIL, the owner may keep writing
+                self.merge(total, shard.copy())
+        return total
+
+    @staticmethod
+    def format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+        pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format"""
+        total = self.snapshot()
+        lines = []
+        for name, (kind, help, label_names, buckets) in self.metrics.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            series = sorted((labels, value) for (metric, labels), value in total.items() if metric == name)
+            for labels, value in series:
+                if kind != 'histogram':
+                    lines.append(f"{name}{self.format_labels(label_names, labels)} {value:g}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + (float('inf'),), value):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                    bucket = self.format_labels(label_names, labels, f'le="{le}"')
+                    lines.append(f"{name}_bucket{bucket} {cumulative}")
+                lines.append(f"{name}_sum{self.format_labels(label_names, labels)} {value[-1]:g}")
+                lines.append(f"{name}_count{self.format_labels(label_names, labels)} {cumulative}")
+        return '\n'.join(lines) + '\n'
+
+def escape_label(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+METRICS = Metrics()
+METRICS.describe('proxy_anonymizer_requests_total', 'counter', "Requests served by the local proxy",
+                 ('method', 'code'))
+METRICS.describe('proxy_anonymizer_request_duration_seconds', 'histogram',
+                 "Time to serve a request, for CONNECT the lifetime of the tunnel", ('method',))
+METRICS.describe('proxy_anonymizer_active_connections', 'gauge', "Client connections open on the local proxy")
+METRICS.describe('proxy_anonymizer_tunnels_total', 'counter', "Tunnels opened through upstreams", ('kind',))
+METRICS.describe('proxy_anonymizer_tunnel_bytes_total', 'counter',
+                 "Bytes relayed through tunnels, sent is client to upstream", ('direction',))
+METRICS.describe('proxy_anonymizer_upstream_requests_total', 'counter',
+                 "Requests and tunnels sent to upstreams by connection type and outcome", ('type', 'result'))
+METRICS.describe('proxy_anonymizer_upstream_latency_seconds', 'histogram',
+                 "Time until an upstream answered a request or opened a tunnel")
+METRICS.describe('proxy_anonymizer_upstream_breaker_trips_total', 'counter',
+                 "Times an upstream's circuit breaker opened after failing requests in a row", ('type',))
+METRICS.describe('proxy_anonymizer_upstream_failovers_total', 'counter',
+                 "Requests retried on another upstream after theirs failed to connect")
+METRICS.describe('proxy_anonymizer_upstream_forced_closes_total', 'counter',
+                 "Connections closed because they outlived the drain grace period after a rotation")
+METRICS.describe('proxy_anonymizer_verifications_total', 'counter', "Proxy checks by outcome", ('result',))
+METRICS.describe('proxy_anonymizer_verification_seconds', 'histogram', "Latency of proxies that passed a check")
+METRICS.describe('proxy_anonymizer_rotations_total', 'counter', "Upstream rotations by connection type", ('type',))
+METRICS.describe('proxy_anonymizer_rotation_errors_total', 'counter', "Rotations that failed")
+METRICS.describe('proxy_anonymizer_rotation_prepare_seconds', 'histogram',
+                 "Time to find, verify and warm the next upstream")
+
+def count_tunnel(kind: str, sent: int, received: int) -> None:
+    """Record a finished tunnel and the bytes it carried"""
+    METRICS.add('proxy_anonymizer_tunnels_total', 1, (kind,))
+    METRICS.add('proxy_anonymizer_tunnel_bytes_total', sent, ('sent',))
+    METRICS.add('proxy_anonymizer_tunnel_bytes_total', received, ('received',))
+
+class ProxyRecord:
+    """One upstream proxy: parsed address, cached URL and health measurements
+
+    Slots hold only what scoring and the database need, so a record costs
+    about as much as the three-key dict it replaced. The URL handed to
+    requests and the tunnel code is built on first use and then cached.
+    Records compare and hash by (type, host, port).
+    """
+
+    __slots__ = ('type', 'host', 'port', 'source', '_url', 'latency', 'success_rate', 'last_checked',
+                 'failure_streak', 'last_success')
+
+    alpha = 0.3  # Weight of the newest sample in the moving averages
+    default_latency = 2.0  # Assumed latency in seconds for proxies never measured
+
+    def __init__(self, proxy_type: str, host: str, port, source: Optional[str] = None,
+                 latency: Optional[float] = None, success_rate: float = 0.5,
+                 last_checked: Optional[float] = None, failure_streak: int = 0,
+                 last_success: Optional[float] = None):
+        port = int(port)
+        if not 0 < port < 65536:
+            raise ValueError(f"invalid port {port}")
+        # Interned, so a big pool holds one copy of each type and source string, and of each port number
+        self.type = sys.intern(str(proxy_type).strip().lower())
+        self.host = str(host).strip().lower().rstrip('.')
+        self.port = PORT_NUMBERS.setdefault(port, port)
+        self.source = sys.intern(source) if source else None
+        self._url: Optional[str] = None
+        self.latency = latency
+        self.success_rate = success_rate
+        self.last_checked = last_checked
+        self.failure_streak = failure_streak
+        self.last_success = last_success
+
+    @classmethod
+    def from_dict(cls, entry: Dict) -> 'ProxyRecord':
+        return cls(entry['type'], entry['host'], entry['port'], entry.get('source'))
+
+    def to_dict(self) -> Dict:
+        entry = {'type': self.type, 'host': self.host, 'port': self.port}
+        if self.source:
+            entry['source'] = self.source
+        return entry
+
+    @property
+    def url(self) -> str:
+        if self._url is None:
+            self._url = f"{PROXY_URL_SCHEMES.get(self.type, self.type)}://{self.host}:{self.port}"
+        return self._url
+
+    @property
+    def key(self) -> Tuple[str, str, int]:
+        return (self.type, self.host, self.port)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, ProxyRecord):
+            return NotImplemented
+        return self.key == other.key
+
+    def __hash__(self) -> int:
+        return hash(self.key)
+
+    def __str__(self) -> str:
+        return f"{self.type}://{self.host}:{self.port}"
+
+    def __repr__(self) -> str:
+        return f"ProxyRecord({self})"
+
+    def record(self, ok: bool, latency: Optional[float] = None) -> None:
+        """Fold a new observation into the moving averages"""
+        self.last_checked = time.time()
+        self.success_rate += self.alpha * ((1.0 if ok else 0.0) - self.success_rate)
+        if ok:
+            self.failure_streak = 0
+            self.last_success = self.last_checked
+            if latency is not None:
+                if self.latency is None:
+                    self.latency = latency
+                else:
+                    self.latency += self.alpha * (latency - self.latency)
+        else:
+            self.failure_streak += 1
+
+    def score(self) -> float:
+        """Expected cost of using this proxy, lower is better"""
+        latency = self.latency if self.latency is not None else self.default_latency
+        return latency / max(self.success_rate, 0.05)
+
+def dedupe_proxies(entries: Iterable) -> List[ProxyRecord]:
+    """Turn scraped entries into records, dropping malformed ones and repeats of an earlier entry"""
+    seen = set()
+    records = []
+    for entry in entries:
+        try:
+            record = entry if isinstance(entry, ProxyRecord) else ProxyRecord.from_dict(entry)
+        except (KeyError, TypeError, ValueError):
+            continue
+        if record.key not in seen:
+            seen.add(record.key)
+            records.append(record)
+    return records
+
+def split_host_port(target: str, default_port: int = 443) -> Tuple[str, int]:
+    """Split host:port, including bracketed IPv6 literals"""
+    if target.startswith('['):
+        host, _, rest = target[1:].partition(']')
+        return host, int(rest[1:]) if rest.startswith(':') else default_port
+    host, sep, port = target.rpartition(':')
+    if not sep:
+        return target, default_port
+    return host, int(port)
+
+def socks5_handshake(host: str, port: int, username: Optional[str] = None, password: Optional[str] = None):
+    """SOCKS5 CONNECT as a generator of (bytes to send, bytes to read) steps
+
+    The destination is sent as a domain name unless it is an IP literal, so
+    the proxy (Tor in particular) does the DNS lookup.
+    """
+    methods = b'\x00\x02' if username else b'\x00'
+    reply = yield b'\x05' + bytes([len(methods)]) + methods, 2
+    if reply[0] != 5 or reply[1] not in methods:
+        raise ConnectionError("SOCKS5 proxy refused our authentication methods")
+    if reply[1] == 2:
+        user, secret = username.encode(), (password or '').encode()
+        reply = yield b'\x01' + bytes([len(user)]) + user + bytes([len(secret)]) + secret, 2
+        if reply[1] != 0:
+            raise ConnectionError("SOCKS5 authentication failed")
+
+    try:
+        address = b'\x01' + socket.inet_pton(socket.AF_INET, host)
+    except OSError:
+        try:
+            address = b'\x04' + socket.inet_pton(socket.AF_INET6, host)
+        except OSError:
+            name = host.encode('idna')
+            address = b'\x03' + bytes([len(name)]) + name
+    reply = yield b'\x05\x01\x00' + address + port.to_bytes(2, 'big'), 4
+    if reply[0] != 5 or reply[1] != 0:
+        raise ConnectionError(f"SOCKS5 connect failed: {SOCKS5_ERRORS.get(reply[1], reply[1])}")
+    # Skip the bound address the proxy reports back
+    if reply[3] == 1:
+        yield b'', 4 + 2
+    elif reply[3] == 4:
+        yield b'', 16 + 2
+    else:
+        length = yield b'', 1
+        yield b'', length[0] + 2
+
+def socks4_handshake(host: str, port: int, username: Optional[str] = None):
+    """SOCKS4 CONNECT, using the 4a extension for names so they resolve remotely"""
+    user = (username or '').encode() + b'\x00'
+    try:
+        request = b'\x04\x01' + port.to_bytes(2, 'big') + socket.inet_aton(host) + user
+    except OSError:
+        request = b'\x04\x01' + port.to_bytes(2, 'big') + b'\x00\x00\x00\x01' + user + host.encode('idna') + b'\x00'
+    reply = yield request, 8
+    if reply[1] != 0x5a:
+        raise ConnectionError(f"SOCKS4 connect failed with code {reply[1]:#x}")
+
+def http_connect_handshake(host: str, port: int):
+    """HTTP CONNECT, reading the response head byte by byte so no tunnel data is consumed"""
+    target = f"[{host}]:{port}" if ':' in host else f"{host}:{port}"
+    response = yield f"CONNECT {target} HTTP/1.1\r\nHost: {target}\r\n\r\n".encode(), None
+    status = response.split(b'\r\n', 1)[0].split(None, 2)
+    if len(status) < 2 or status[1] != b'200':
+        raise ConnectionError("Proxy connection failed")
+
+def tunnel_handshake(proxy: str, host: str, port: int):
+    """Pick the handshake that asks `proxy` for a stream to host:port"""
+    parsed = urlparse(proxy)
+    if parsed.scheme in ('socks5', 'socks5h'):
+        return socks5_handshake(host, port, parsed.username, parsed.password)
+    if parsed.scheme in ('socks4', 'socks4a'):
+        return socks4_handshake(host, port, parsed.username)
+    return http_connect_handshake(host, port)
+
+def recv_exactly(sock: socket.socket, count: Optional[int]) -> bytes:
+    """Read count bytes, or an HTTP head up to the blank line when count is None"""
+    data = bytearray()
+    while count is None or len(data) < count:
+        chunk = sock.recv(1 if count is None else count - len(data))
+        if not chunk:
+            raise ConnectionError("Proxy closed the connection during the handshake")
+        data += chunk
+        if count is None and data.endswith(b'\r\n\r\n'):
+            break
+    return bytes(data)
+
+def run_handshake(steps, sock: socket.socket):
+    """Drive a handshake generator over a blocking socket, returns its result"""
+    reply = None
+    while True:
+        try:
+            data, count = steps.send(reply)
+        except StopIteration as done:
+            return done.value
+        if data:
+            sock.sendall(data)
+        reply = recv_exactly(sock, count)
+
+async def run_handshake_async(steps, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Drive a handshake generator over asyncio streams, returns its result"""
+    reply = None
+    while True:
+        try:
+            data, count = steps.send(reply)
+        except StopIteration as done:
+            return done.value
+        if data:
+            writer.write(data)
+            await writer.drain()
+        reply = await (reader.readuntil(b'\r\n\r\n') if count is None else reader.readexactly(count))
+
+def open_tunnel(proxy: str, host: str, port: int, timeout: float = 10) -> socket.socket:
+    """Open a TCP stream to host:port through an HTTP, SOCKS4 or SOCKS5 proxy"""
+    parsed = urlparse(proxy)
+    sock = socket.create_connection((parsed.hostname, parsed.port), timeout=timeout)
+    try:
+        run_handshake(tunnel_handshake(proxy, host, port), sock)
+        sock.settimeout(None)
+        return sock
+    except Exception:
+        sock.close()
+        raise
+
+async def open_tunnel_async(proxy: str, host: str, port: int, limit: int = RELAY_CHUNK_SIZE) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    """Asyncio version of open_tunnel"""
+    parsed = urlparse(proxy)
+    reader, writer = await asyncio.open_connection(parsed.hostname, parsed.port, limit=limit)
+    try:
+        await run_handshake_async(tunnel_handshake(proxy, host, port), reader, writer)
+        return reader, writer
+    except Exception:
+        writer.close()
+        raise
+
+def socks5_server_handshake():
+    """Server side of a SOCKS5 CONNECT after the version byte, returns the requested (host, port)"""
+    count = yield b'', 1
+    methods = yield b'', count[0]
+    if 0 not in methods:
+        yield b'\x05\xff', 0
+        raise ConnectionError("SOCKS5 client offers no usable authentication method")
+    request = yield b'\x05\x00', 4
+    if request[0] != 5:
+        raise ConnectionError("Malformed SOCKS5 request")
+    if request[3] == 1:
+        address = yield b'', 4
+        host = socket.inet_ntop(socket.AF_INET, address)
+    elif request[3] == 4:
+        address = yield b'', 16
+        host = socket.inet_ntop(socket.AF_INET6, address)
+    elif request[3] == 3:
+        length = yield b'', 1
+        host = (yield b'', length[0]).decode('idna')
+    else:
+        yield socks5_reply(8), 0
+        raise ConnectionError("Unsupported SOCKS5 address type")
+    port = int.from_bytes((yield b'', 2), 'big')
+    if request[1] != 1:
+        # Only CONNECT is relayed, BIND and UDP ASSOCIATE are refused
+        yield socks5_reply(7), 0
+        raise ConnectionError("Unsupported SOCKS5 command")
+    return host, port
+
+def socks5_reply(code: int) -> bytes:
+    """SOCKS5 reply with an empty IPv4 bound address"""
+    return b'\x05' + bytes([code]) + b'\x00\x01\x00\x00\x00\x00\x00\x00'
+
+class SocketPipe:
+    """Forwards one direction of a tunnel, in the kernel with splice where possible"""
+
+    def __init__(self, source: socket.socket, target: socket.socket, buffer_size: int = RELAY_CHUNK_SIZE):
+        self.source = source
+        self.target = target
+        self.buffer_size = buffer_size
+        self.bytes = 0
+        self.pipe = None
+        if hasattr(os, 'splice'):
+            try:
+                self.pipe = os.pipe()
+                # A bigger pipe moves more per splice call
+                self.buffer_size = fcntl.fcntl(self.pipe[1], fcntl.F_SETPIPE_SZ, SPLICE_PIPE_SIZE)
+            except OSError:
+                pass
+        # Reused for every read when splice is not available
+        self.buffer = bytearray(buffer_size) if self.pipe is None else None
+
+    def close(self) -> None:
+        if self.pipe:
+            for fd in self.pipe:
+                os.close(fd)
+            self.pipe = None
+
+    def pump(self) -> int:
+        """Move whatever the source has ready to the target, returns 0 on EOF"""
+        if self.pipe:
+            try:
+                return self.splice()
+            except OSError as e:
+                if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                    raise
+                # Socket type not supported by splice, copy through userspace instead
+                self.close()
+                self.buffer = bytearray(self.buffer_size)
+        view = memoryview(self.buffer)
+        count = self.source.recv_into(self.buffer)
+        if count:
+            self.target.sendall(view[:count])
+            self.bytes += count
+        return count
+
+    def splice(self) -> int:
+        read_end, write_end = self.pipe
+        count = os.splice(self.source.fileno(), write_end, self.buffer_size,
+                          flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        remaining = count
+        while remaining:
+            remaining -= os.splice(read_end, self.target.fileno(), remaining, flags=os.SPLICE_F_MOVE)
+        self.bytes += count
+        return count
+
+def tunnel_sockets(client: socket.socket, target: socket.socket) -> Tuple[int, int]:
+    """Relay bytes both ways until both sides are done, returns (sent, received) byte counts
+
+    Each side's EOF is passed on as a half-close, so the other direction
+    keeps flowing until it ends too. Writes are complete even when the
+    kernel only accepts part of a buffer.
+    """
+    upstream = SocketPipe(client, target)
+    downstream = SocketPipe(target, client)
+    # Unlike select.select, the selector keeps working for descriptors above FD_SETSIZE
+    selector = selectors.DefaultSelector()
+    selector.register(client, selectors.EVENT_READ, upstream)
+    selector.register(target, selectors.EVENT_READ, downstream)
+    open_sides = 2
+    try:
+        while open_sides:
+            for key, _ in selector.select():
+                pipe = key.data
+                try:
+                    count = pipe.pump()
+                except (ConnectionResetError, BrokenPipeError):
+                    return upstream.bytes, downstream.bytes
+                if not count:
+                    selector.unregister(key.fileobj)
+                    open_sides -= 1
+                    try:
+                        pipe.target.shutdown(socket.SHUT_WR)
+                    except OSError:
+                        pass
+        return upstream.bytes, downstream.bytes
+    finally:
+        selector.close()
+        upstream.close()
+        downstream.close()
+
+class BodyReader:
+    """Stream a request body of known length from the client in chunks"""
+
+    def __init__(self, rfile, length: int):
+        self.rfile = rfile
+        self.length = length
+
+    def __len__(self) -> int:
+        # Lets requests send a Content-Length header instead of chunking
+        return self.length
+
+    def __iter__(self):
+        remaining = self.length
+        while remaining > 0:
+            data = self.rfile.read(min(remaining, RELAY_CHUNK_SIZE))
+            if not data:
+                raise ConnectionError("Client closed the connection mid-body")
+            remaining -= len(data)
+            yield data
+
+class ChunkedBodyReader:
+    """Decode a chunked request body from the client as it arrives"""
+
+    def __init__(self, rfile):
+        self.rfile = rfile
+
+    def __iter__(self):
+        while True:
+            size_line = self.rfile.readline(65537)
+            size = int(size_line.split(b';', 1)[0].strip(), 16)
+            if size == 0:
+                # Skip trailers up to the terminating empty line
+                while self.rfile.readline(65537) not in (b'\r\n', b'\n', b''):
+                    pass
+                return
+            remaining = size
+            while remaining > 0:
+                data = self.rfile.read(min(remaining, RELAY_CHUNK_SIZE))
+                if not data:
+                    raise ConnectionError("Client closed the connection mid-body")
+                remaining -= len(data)
+                yield data
+            self.rfile.readline(65537)
+
 class ProxyHandler(http.server.SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Seconds an idle keep-alive client may wait before sending its next request
+    timeout = 60
+    # Seconds an upstream may pause while streaming a response body
+    body_timeout = 10
+
+    def __init__(self, *args, **kwargs):
+        # Every request leases the upstream that is current when it starts
+        self.upstreams: UpstreamSwitch = kwargs.pop('upstreams')
+        self.sessions: Optional[UpstreamSessionPool] = kwargs.pop('sessions', None)
+        self.status_code: Optional[int] = None
+        super().__init__(*args, **kwargs)
+
+    def log_message(self, format, *args):
+        """Keep per-request lines out of the terminal, they go to the debug log"""
+        logging.debug(f"{self.address_string()} {format % args}")
+
+    def send_response_only(self, code, message=None):
+        self.status_code = code
+        super().send_response_only(code, message)
+
+    def instrumented(self, method: str, handler: Callable[[], None]) -> None:
+        """Serve one request, recording its status and duration"""
+        self.status_code = None
+        started = time.monotonic()
+        try:
+            handler()
+        finally:
+            METRICS.add('proxy_anonymizer_requests_total', 1, (method, str(self.status_code or 0)))
+            METRICS.observe('proxy_anonymizer_request_duration_seconds', time.monotonic() - started, (method,))
+
+    def send_metrics(self) -> None:
+        """Serve /metrics for requests made to the local proxy itself"""
+        body = METRICS.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def shutdown_connection(self) -> None:
+        """Cut the client connection from another thread, ending a relay in progress"""
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def send_error(self, code, message=None):
+        """Override send_error to suppress error messages"""
+        self.close_connection = True
+        try:
+            self.send_response(code)
+            self.send_header('Content-Length', '0')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+        except Exception:
+            pass
+
+    def do_CONNECT(self):
+        self.instrumented('CONNECT', self.connect)
+
+    def connect(self):
+        """Handle CONNECT requests"""
+        try:
+            # Parse the host and port from the path
+            host, port = split_host_port(self.path)
+
+            # Open a stream to the target server through the proxy, speaking
+            # HTTP CONNECT or SOCKS depending on the upstream type
+            upstream, target_socket = self.upstreams.failover(
+                host,
+                lambda upstream, deadline: open_tunnel(
+                    upstream.url, host, port, self.upstreams.time_left(deadline, self.upstreams.connect_timeout)
+                )
+            )
+            try:
+                # Send 200 Connection established to client
+                self.close_connection = True
+                self.send_response(200, 'Connection established')
+                self.send_header('Connection', 'close')
+                self.end_headers()
+
+                # Create a tunnel between the client and target, it stays on
+                # this upstream until it closes or the upstream's grace period ends
+                upstream.track(self.shutdown_connection)
+                try:
+                    self.tunnel(target_socket)
+                finally:
+                    upstream.untrack(self.shutdown_connection)
+            finally:
+                self.upstreams.release(upstream)
+        except Exception:
+            self.send_error(500)
+
+    def tunnel(self, target_socket):
+        """Create a tunnel between client and target"""
+        try:
+            # A tunnel may idle as long as both ends like, and splice needs blocking sockets
+            self.connection.settimeout(None)
+            sent, received = tunnel_sockets(self.connection, target_socket)
+            count_tunnel('connect', sent, received)
+            logging.debug(f"Tunnel to {self.path} closed: {sent} bytes sent, {received} bytes received")
+        except Exception:
+            pass
+        finally:
+            target_socket.close()
+
+    def target_url(self) -> str:
+        """Get the full URL of the request"""
+        url = self.path
+        if not url.startswith('http'):
+            url = 'http://' + self.headers.get('Host', '') + url
+        return url
+
+    def request_body(self) -> Optional[Iterable[bytes]]:
+        """Return the client's request body as a stream, without buffering it"""
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            return ChunkedBodyReader(self.rfile)
+        content_length = int(self.headers.get('Content-Length') or 0)
+        if content_length > 0:
+            return BodyReader(self.rfile, content_length)
+        return None
+
+    def write_chunk(self, data: bytes) -> None:
+        """Write one chunk in chunked transfer encoding"""
+        self.wfile.write(b'%x\r\n' % len(data))
+        self.wfile.write(data)
+        self.wfile.write(b'\r\n')
+
+    def forward(self, method: str) -> None:
+        """Relay the request through the current proxy, streaming both bodies"""
+        headers_sent = False
+        try:
+            # Forward the request through the current proxy, reusing its pooled connections
+            with self.relay_response(method) as response:
+                has_body = method != 'HEAD' and response.status_code not in (204, 304)
+                length = response.headers.get('Content-Length')
+                # Without a length the body is re-chunked for HTTP/1.1 clients
+                # and delimited by closing the connection for HTTP/1.0 ones
+                chunked = has_body and length is None and self.request_version == 'HTTP/1.1'
+                if has_body and length is None and not chunked:
+                    self.close_connection = True
+
+                # Relay the upstream's own Server and Date headers untouched
+                self.log_request(response.status_code)
+                self.send_response_only(response.status_code, response.reason)
+                for key, value in response.raw.headers.items():
+                    if key.lower() not in HOP_BY_HOP_HEADERS:
+                        self.send_header(key, value)
+                if chunked:
+                    self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                headers_sent = True
+
+                if has_body:
+                    for data in response.raw.stream(RELAY_CHUNK_SIZE, decode_content=False):
+                        if chunked:
+                            self.write_chunk(data)
+                        else:
+                            self.wfile.write(data)
+                    if chunked:
+                        self.wfile.write(b'0\r\n\r\n')
+        except Exception:
+            if headers_sent:
+                # Too late for an error response, the client sees a cut body
+                self.close_connection = True
+            else:
+                self.send_error(500)
+
+    def send_upstream(self, method: str, upstream: 'Upstream', body: Optional[Iterable[bytes]],
+                      deadline: float) -> requests.Response:
+        """Send the request through one upstream, giving up early on one that does not connect or answer"""
+        headers = {'User-Agent': USER_AGENT}
+        if self.headers.get('Content-Type'):
+            headers['Content-Type'] = self.headers['Content-Type']
+        client = self.sessions.session_for(upstream.proxies) if self.sessions else requests
+        response = client.request(
+            method,
+            self.target_url(),
+            data=body,
+            proxies=upstream.proxies,
+            timeout=(
+                self.upstreams.time_left(deadline, self.upstreams.connect_timeout),
+                self.upstreams.time_left(deadline, self.upstreams.header_timeout)
+            ),
+            headers=headers,
+            stream=True,
+            allow_redirects=False
+        )
+        # The read timeout was for the response head, the body may pause for longer
+        sock = getattr(response.raw.connection, 'sock', None)
+        try:
+            sock.settimeout(self.body_timeout)
+        except (AttributeError, OSError) as e:
+            # A connection closing after the response has already handed its socket over
+            logging.warning(f"Can't reach the socket of {upstream.label} to widen its read timeout, "
+                            f"the body keeps the response head's timeout: {e!r}")
+        return response
+
+    @contextlib.contextmanager
+    def relay_response(self, method: str):
+        """Send the request to one of the current upstreams and yield its streamed response"""
+        body = self.request_body()
+        # A streamed body is gone after the first try, so only bodiless requests move to another upstream
+        upstream, response = self.upstreams.failover(
+            urlparse(self.target_url()).hostname,
+            lambda upstream, deadline: self.send_upstream(method, upstream, body, deadline),
+            retries=None if body is None else 0
+        )
+        # A long download is cut if it outlives the upstream's grace period
+        upstream.track(self.shutdown_connection)
+        try:
+            with response:
+                yield response
+        finally:
+            upstream.untrack(self.shutdown_connection)
+            self.upstreams.release(upstream)
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self.send_metrics()
+            return
+        self.instrumented('GET', lambda: self.forward('GET'))
+
+    def do_HEAD(self):
+        # SimpleHTTPRequestHandler would answer from local files instead
+        self.instrumented('HEAD', lambda: self.forward('HEAD'))
+
+    def do_POST(self):
+        self.instrumented('POST', lambda: self.forward('POST'))
+
+class SocksHandler(socketserver.BaseRequestHandler):
+    """Serve SOCKS5 CONNECT requests from local clients through the current proxy"""
+
+    # Seconds a client may take over the handshake
+    timeout = 60
+
+    def __init__(self, *args, **kwargs):
+        self.upstreams: UpstreamSwitch = kwargs.pop('upstreams')
+        super().__init__(*args, **kwargs)
+
+    def shutdown_connection(self) -> None:
+        try:
+            self.request.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def handle(self):
+        client = self.request
+        try:
+            client.settimeout(self.timeout)
+            recv_exactly(client, 1)  # Version byte, already sniffed by the server
+            host, port = run_handshake(socks5_server_handshake(), client)
+            client.settimeout(None)
+        except (OSError, ValueError, IndexError):
+            return
+
+        try:
+            upstream, target_socket = self.upstreams.failover(
+                host,
+                lambda upstream, deadline: open_tunnel(
+                    upstream.url, host, port, self.upstreams.time_left(deadline, self.upstreams.connect_timeout)
+                )
+            )
+        except Exception:
+            try:
+                client.sendall(socks5_reply(1))
+            except OSError:
+                pass
+            return
+
+        upstream.track(self.shutdown_connection)
+        try:
+            client.sendall(socks5_reply(0))
+            sent, received = tunnel_sockets(client, target_socket)
+            count_tunnel('socks', sent, received)
+            logging.debug(f"SOCKS tunnel to {host}:{port} closed: {sent} bytes sent, {received} bytes received")
+        except Exception:
+            pass
+        finally:
+            upstream.untrack(self.shutdown_connection)
+            target_socket.close()
+            self.upstreams.release(upstream)
+
+class ThreadedHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """Handle requests in a separate thread."""
+    # Handler factory for clients that open with a SOCKS5 greeting on the same port
+    socks_handler = None
+    # Closing the server cuts open connections instead of waiting for idle keep-alive clients
+    daemon_threads = True
+    block_on_close = False
+
     def __init__(self, *args, **kwargs):
-        self.proxies = kwargs.pop('proxies', None)
+        self.connections: set = set()
+        self.connections_lock = threading.Lock()
         super().__init__(*args, **kwargs)
-        # Disable all logging
-        self.log_message = lambda *args: None
-        self.log_error = lambda *args: None
-        self.log_request = lambda *args: None
 
-    def send_error(self, code, message=None):
-        """Override send_error to suppress error messages"""
+    def finish_request(self, request, client_address):
+        METRICS.add('proxy_anonymizer_active_connections', 1)
+        with self.connections_lock:
+            self.connections.add(request)
+        try:
+            self.dispatch(request, client_address)
+        finally:
+            with self.connections_lock:
+                self.connections.discard(request)
+            METRICS.add('proxy_anonymizer_active_connections', -1)
+
+    def server_close(self):
+        """Stop listening and wake every handler thread still blocked on its client"""
+        super().server_close()
+        with self.connections_lock:
+            connections = list(self.connections)
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def dispatch(self, request, client_address):
+        if self.socks_handler:
+            # A client that connects and stays silent must not hold this thread forever,
+            # returning on a timeout has the server close its socket
+            request.settimeout(ProxyHandler.timeout)
+            try:
+                first = request.recv(1, socket.MSG_PEEK)
+            except OSError:
+                return
+            if first == b'\x05':
+                self.socks_handler(request, client_address, self)
+                return
+        super().finish_request(request, client_address)
+
+class AsyncProxyServer:
+    """Local proxy server that runs every connection on one asyncio event loop
+
+    Mirrors ProxyHandler and SocksHandler: plain HTTP requests are forwarded
+    to the current upstream proxy, while CONNECT requests and SOCKS5 clients
+    on the same port get tunnels through it. Only
+    max_connections clients are served at once and every relay waits for
+    the receiving side to drain, so memory per connection stays bounded.
+    """
+
+    # Request headers passed on to the upstream, everything else is dropped
+    FORWARDED_HEADERS = {'host', 'content-type', 'content-length', 'transfer-encoding'}
+
+    def __init__(self, port: int, upstreams: 'UpstreamSwitch', max_connections: int = 1024, timeout: float = 10):
+        self.port = port
+        self.upstreams = upstreams
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.active_connections = 0
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.stopped: Optional[asyncio.Event] = None
+
+    def serve_forever(self) -> None:
+        asyncio.run(self.serve())
+
+    async def serve(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        server = await asyncio.start_server(
+            self.handle, '127.0.0.1', self.port,
+            limit=RELAY_CHUNK_SIZE, backlog=socket.SOMAXCONN
+        )
+        async with server:
+            await self.stopped.wait()
+
+    def shutdown(self) -> None:
+        if self.loop and self.stopped:
+            self.loop.call_soon_threadsafe(self.stopped.set)
+
+    def server_close(self) -> None:
+        """Nothing to release, the listening socket closes with the loop"""
+        pass
+
+    @staticmethod
+    async def read_head(reader: asyncio.StreamReader, prefix: bytes = b'') -> Tuple[str, List[Tuple[str, str]]]:
+        """Read a request or status line plus headers"""
+        head = prefix + await reader.readuntil(b'\r\n\r\n')
+        lines = head.decode('latin-1').split('\r\n')
+        headers = []
+        for line in lines[1:]:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers.append((name.strip(), value.strip()))
+        return lines[0], headers
+
+    @staticmethod
+    async def relay(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> int:
+        """Copy one direction until EOF, waiting for the writer to drain after every read"""
+        relayed = 0
+        try:
+            while True:
+                data = await reader.read(RELAY_CHUNK_SIZE)
+                if not data:
+                    break
+                writer.write(data)
+                relayed += len(data)
+                await writer.drain()
+            if writer.can_write_eof():
+                writer.write_eof()
+        except (OSError, RuntimeError):
+            pass
+        return relayed
+
+    def closer(self, writer: asyncio.StreamWriter) -> Callable[[], None]:
+        """Callback that aborts a connection from the upstream switch's timer thread"""
+        return lambda: self.loop.call_soon_threadsafe(writer.transport.abort)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        if self.active_connections >= self.max_connections:
+            writer.write(b'HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+            writer.close()
+            return
+        self.active_connections += 1
+        METRICS.add('proxy_anonymizer_active_connections', 1)
+        writer.transport.set_write_buffer_limits(high=RELAY_CHUNK_SIZE * 4)
+        upstream_writer = None
+        upload = None
+        lease = None
+        abort = self.closer(writer)
+        method = None
+        status = 0
+        request_started = time.monotonic()
+        try:
+            first = await asyncio.wait_for(reader.readexactly(1), self.timeout)
+            if first == b'\x05':
+                try:
+                    await self.handle_socks(reader, writer)
+                except (Exception, asyncio.TimeoutError):
+                    pass
+                return
+            request_line, headers = await asyncio.wait_for(self.read_head(reader, first), self.timeout)
+            method, target, _ = request_line.split(' ', 2)
+            if method == 'GET' and target == '/metrics':
+                # Asked of the local proxy itself rather than proxied
+                body = METRICS.render().encode()
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                             b'Content-Length: %d\r\nConnection: close\r\n\r\n' % len(body) + body)
+                await writer.drain()
+                method = None
+                return
+            if method == 'CONNECT':
+                host = split_host_port(target)[0]
+            else:
+                host = self.absolute_url(target, headers).hostname
+            has_body = any(name.lower() == 'transfer-encoding' or (name.lower() == 'content-length' and value != '0')
+                           for name, value in headers)
+            try:
+                # The connection stays on the upstream it was given, even across a swap,
+                # and a request whose body has not been read yet moves on if it fails
+                lease, (upstream_reader, upstream_writer, upload, status_line, response_headers) = \
+                    await self.upstreams.failover_async(
+                        host,
+                        lambda upstream, deadline: self.open_upstream(upstream, reader, method, target, headers, deadline),
+                        retries=0 if has_body else None
+                    )
+            except Exception as e:
+                # Answered with a 500 like any upstream failure, not taken for a bad client request
+                raise ConnectionError(f"No upstream could serve {host}: {e!r}") from e
+            lease.track(abort)
+
+            if method == 'CONNECT':
+                status = 200
+                writer.write(b'HTTP/1.1 200 Connection established\r\nConnection: close\r\n\r\n')
+            else:
+                status = int(status_line.split(' ', 2)[1])
+                response = [status_line]
+                response += [f"{name}: {value}" for name, value in response_headers
+                             if name.lower() not in ('connection', 'keep-alive', 'proxy-connection')]
+                response.append('Connection: close\r\n\r\n')
+                writer.write('\r\n'.join(response).encode('latin-1'))
+            await writer.drain()
+
+            # Both directions are relayed; a plain request is done once the
+            # response has been sent, a tunnel once both sides are closed
+            if method == 'CONNECT':
+                upload = asyncio.ensure_future(self.relay(reader, upstream_writer))
+            received = await self.relay(upstream_reader, writer)
+            if method == 'CONNECT':
+                count_tunnel('connect', await upload, received)
+        except (asyncio.LimitOverrunError, ValueError):
+            status = 400
+            writer.write(b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+        except asyncio.IncompleteReadError:
+            pass
+        except Exception:
+            try:
+                status = 500
+                writer.write(b'HTTP/1.1 500 Internal Server Error\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+            except Exception:
+                pass
+        finally:
+            self.active_connections -= 1
+            METRICS.add('proxy_anonymizer_active_connections', -1)
+            if method:
+                METRICS.add('proxy_anonymizer_requests_total', 1, (method, str(status)))
+                METRICS.observe('proxy_anonymizer_request_duration_seconds', time.monotonic() - request_started, (method,))
+            if upload:
+                await cancel_tasks([upload])
+            if upstream_writer:
+                upstream_writer.close()
+            writer.close()
+            if lease:
+                lease.untrack(abort)
+                self.upstreams.release(lease)
+
+    async def open_upstream(self, upstream: 'Upstream', reader: asyncio.StreamReader, method: str, target: str,
+                            headers: List[Tuple[str, str]], deadline: float):
+        """Connect to the upstream and, unless tunnelling, send the request and read the response head"""
+        socks = urlparse(upstream.url).scheme in SOCKS_SCHEMES
+        connect_timeout = self.upstreams.time_left(deadline, self.upstreams.connect_timeout)
+        if method == 'CONNECT':
+            upstream_reader, upstream_writer = await asyncio.wait_for(
+                open_tunnel_async(upstream.url, *split_host_port(target)),
+                connect_timeout
+            )
+        elif socks:
+            # A SOCKS upstream carries plain HTTP as a tunnel to the origin server
+            url = self.absolute_url(target, headers)
+            upstream_reader, upstream_writer = await asyncio.wait_for(
+                open_tunnel_async(upstream.url, url.hostname, url.port or 80),
+                connect_timeout
+            )
+        else:
+            parsed = urlparse(upstream.url)
+            upstream_reader, upstream_writer = await asyncio.wait_for(
+                asyncio.open_connection(parsed.hostname, parsed.port, limit=RELAY_CHUNK_SIZE),
+                connect_timeout
+            )
+        upload = None
+        try:
+            upstream_writer.transport.set_write_buffer_limits(high=RELAY_CHUNK_SIZE * 4)
+            if method == 'CONNECT':
+                return upstream_reader, upstream_writer, None, None, None
+            upstream_writer.write(self.rewrite_request(method, target, headers, origin_form=socks))
+            # The upstream may wait for the request body before answering
+            upload = asyncio.ensure_future(self.relay(reader, upstream_writer))
+            status_line, response_headers = await asyncio.wait_for(
+                self.read_head(upstream_reader),
+                self.upstreams.time_left(deadline, self.upstreams.header_timeout)
+            )
+            return upstream_reader, upstream_writer, upload, status_line, response_headers
+        except BaseException:
+            if upload:
+                await cancel_tasks([upload])
+            upstream_writer.close()
+            raise
+
+    async def handle_socks(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Serve a SOCKS5 client whose version byte has already been read"""
+        host, port = await asyncio.wait_for(
+            run_handshake_async(socks5_server_handshake(), reader, writer),
+            self.timeout
+        )
+        try:
+            upstream, (upstream_reader, upstream_writer) = await self.upstreams.failover_async(
+                host,
+                lambda upstream, deadline: asyncio.wait_for(
+                    open_tunnel_async(upstream.url, host, port),
+                    self.upstreams.time_left(deadline, self.upstreams.connect_timeout)
+                )
+            )
+        except Exception:
+            writer.write(socks5_reply(1))
+            return
+        abort = self.closer(writer)
+        upstream.track(abort)
+        try:
+            await self.socks_tunnel(reader, writer, upstream_reader, upstream_writer)
+        finally:
+            upstream.untrack(abort)
+            self.upstreams.release(upstream)
+
+    async def socks_tunnel(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                           upstream_reader: asyncio.StreamReader, upstream_writer: asyncio.StreamWriter) -> None:
+        """Relay a SOCKS client over the tunnel opened for it"""
+        upload = None
+        try:
+            upstream_writer.transport.set_write_buffer_limits(high=RELAY_CHUNK_SIZE * 4)
+            writer.write(socks5_reply(0))
+            upload = asyncio.ensure_future(self.relay(reader, upstream_writer))
+            received = await self.relay(upstream_reader, writer)
+            count_tunnel('socks', await upload, received)
+        finally:
+            if upload:
+                await cancel_tasks([upload])
+            upstream_writer.close()
+
+    @staticmethod
+    def absolute_url(target: str, headers: List[Tuple[str, str]]):
+        """Parse the request target, completing origin-form targets from the Host header"""
+        if not target.startswith('http'):
+            host = next((value for name, value in headers if name.lower() == 'host'), '')
+            target = f"http://{host}{target}"
+        return urlparse(target)
+
+    def rewrite_request(self, method: str, target: str, headers: List[Tuple[str, str]], origin_form: bool = False) -> bytes:
+        """Build the request sent upstream, absolute-form for HTTP proxies and origin-form for tunnels"""
+        url = self.absolute_url(target, headers)
+        if origin_form:
+            path = url.path or '/'
+            target = f"{path}?{url.query}" if url.query else path
+        else:
+            target = url.geturl()
+        lines = [f"{method} {target} HTTP/1.1"]
+        lines += [f"{name}: {value}" for name, value in headers if name.lower() in self.FORWARDED_HEADERS]
+        if not any(name.lower() == 'host' for name, _ in headers):
+            lines.append(f"Host: {url.netloc}")
+        lines.append(f"User-Agent: {USER_AGENT}")
+        lines.append('Connection: close\r\n\r\n')
+        return '\r\n'.join(lines).encode('latin-1')
+
+class ProxyPool:
+    """Proxy list with health scores and best-of-k selection
+
+    Records are indexed by their key, so membership, updates and removal are
+    O(1) and the same proxy is never listed twice. Additions, removals and
+    health changes are remembered until take_changes() so the database only
+    has to write what changed.
+    """
+
+    def __init__(self, proxies: Optional[Iterable[ProxyRecord]] = None):
+        self.lock = threading.Lock()
+        self.proxies: List[ProxyRecord] = dedupe_proxies(proxies or [])
+        # Records hash by key, so they are their own index keys
+        self.index: Dict[ProxyRecord, int] = {proxy: position for position, proxy in enumerate(self.proxies)}
+        self.dirty: set = set()
+        self.removed: set = set()
+
+    def __len__(self) -> int:
+        return len(self.proxies)
+
+    def __iter__(self):
+        return iter(list(self.proxies))
+
+    def __contains__(self, proxy: ProxyRecord) -> bool:
+        return proxy in self.index
+
+    def get(self, proxy: ProxyRecord) -> Optional[ProxyRecord]:
+        """The pooled record with the same key as `proxy`, if any"""
+        with self.lock:
+            position = self.index.get(proxy)
+            return self.proxies[position] if position is not None else None
+
+    def _add(self, proxy: ProxyRecord) -> bool:
+        position = self.index.get(proxy)
+        if position is None:
+            self.index[proxy] = len(self.proxies)
+            self.proxies.append(proxy)
+        else:
+            # Already listed, keep its health and refresh the source in place
+            pooled = self.proxies[position]
+            if proxy.source:
+                pooled.source = proxy.source
+            proxy = pooled
+        self.dirty.add(proxy)
+        self.removed.discard(proxy)
+        return position is None
+
+    def add(self, proxy: ProxyRecord) -> bool:
+        """Add a proxy or update the listed one, returns True if it is new"""
+        with self.lock:
+            return self._add(proxy)
+
+    def merge(self, proxies: Iterable[ProxyRecord]) -> int:
+        """Add many proxies in one pass, returns how many were new"""
+        with self.lock:
+            return sum(self._add(proxy) for proxy in proxies)
+
+    def replace(self, proxies: Iterable[ProxyRecord]) -> None:
+        """Swap in a new proxy list, forgetting proxies that left it"""
+        proxies = dedupe_proxies(proxies)
+        with self.lock:
+            old_index = self.index
+            self.proxies = proxies
+            self.index = {proxy: position for position, proxy in enumerate(proxies)}
+            self.dirty.update(proxy for proxy in proxies if proxy not in old_index)
+            self.removed.update(proxy for proxy in old_index if proxy not in self.index)
+            self.removed.difference_update(proxies)
+
+    def remove(self, proxy: ProxyRecord) -> bool:
+        """Drop a proxy, returns False if it wasn't in the pool"""
+        with self.lock:
+            position = self.index.pop(proxy, None)
+            if position is None:
+                return False
+            # Move the last entry into the hole instead of shifting the whole list
+            last = self.proxies.pop()
+            if position < len(self.proxies):
+                self.proxies[position] = last
+                self.index[last] = position
+            self.dirty.discard(proxy)
+            self.removed.add(proxy)
+            return True
+
+    def load(self, proxies: List[ProxyRecord]) -> None:
+        """Replace the whole pool with stored records, nothing is marked as changed"""
+        with self.lock:
+            self.proxies = dedupe_proxies(proxies)
+            self.index = {proxy: position for position, proxy in enumerate(self.proxies)}
+            self.dirty = set()
+            self.removed = set()
+
+    def record(self, proxy: ProxyRecord, ok: bool, latency: Optional[float] = None) -> None:
+        """Feed a verification or live traffic result into the proxy's score"""
+        with self.lock:
+            position = self.index.get(proxy)
+            if position is None:
+                # Not pooled (yet), the candidate carries its own health until merged
+                proxy.record(ok, latency)
+                return
+            pooled = self.proxies[position]
+            pooled.record(ok, latency)
+            self.dirty.add(pooled)
+
+    def select(self, k: int = 3) -> Optional[ProxyRecord]:
+        """Pick the best scoring proxy out of k random candidates"""
+        with self.lock:
+            if not self.proxies:
+                return None
+            candidates = random.sample(self.proxies, min(k, len(self.proxies)))
+            return min(candidates, key=ProxyRecord.score)
+
+    def best(self, k: int) -> List[ProxyRecord]:
+        """The k best scoring proxies without recent failures"""
+        with self.lock:
+            return heapq.nsmallest(k, (proxy for proxy in self.proxies if not proxy.failure_streak),
+                                   key=ProxyRecord.score)
+
+    def take_changes(self) -> Tuple[List[ProxyRecord], List[Tuple[str, str, int]]]:
+        """Return and forget the records to write and keys to delete since the last call"""
+        with self.lock:
+            # In list order, so new rows keep the pool's order in the database
+            changed = sorted((proxy for proxy in self.dirty if proxy in self.index), key=self.index.__getitem__)
+            removed = [proxy.key for proxy in self.removed]
+            self.dirty = set()
+            self.removed = set()
+            return changed, removed
+
+class ProxyStore:
+    """SQLite database of proxies and their verification history
+
+    Runs in WAL mode so readers never wait on the writer. Writes are
+    incremental: sync() only touches the rows the pool reports as changed.
+    """
+
+    HISTORY_DAYS = 30  # Verification results older than this are pruned
+    PRUNE_INTERVAL = 3600  # Seconds between prunes, a daemon may run for months without a restart
+    TABLES = """
+        CREATE TABLE IF NOT EXISTS proxies (
+            type TEXT NOT NULL,
+            host TEXT NOT NULL,
+            port INTEGER NOT NULL,
+            source TEXT,
+            added_at REAL,
+            latency REAL,
+            success_rate REAL,
+            failure_streak INTEGER NOT NULL DEFAULT 0,
+            last_checked REAL,
+            last_success REAL,
+            PRIMARY KEY (type, host, port)
+        );
+        CREATE TABLE IF NOT EXISTS checks (
+            type TEXT NOT NULL,
+            host TEXT NOT NULL,
+            port INTEGER NOT NULL,
+            checked_at REAL NOT NULL,
+            ok INTEGER NOT NULL,
+            latency REAL
+        );
+        CREATE TABLE IF NOT EXISTS state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """
+    INDEXES = """
+        CREATE INDEX IF NOT EXISTS proxies_failure_streak ON proxies (failure_streak);
+        CREATE INDEX IF NOT EXISTS proxies_latency ON proxies (latency);
+        CREATE INDEX IF NOT EXISTS proxies_last_checked ON proxies (last_checked);
+        CREATE INDEX IF NOT EXISTS checks_proxy ON checks (type, host, port, checked_at);
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.pending_checks: List[Tuple] = []
+        self.db = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(self.TABLES + self.INDEXES)
+        with self.lock:
+            self._prune()
+
+    def _prune(self) -> None:
+        """Drop verification history past HISTORY_DAYS, the caller holds the lock"""
+        self.db.execute("DELETE FROM checks WHERE checked_at < ?", (time.time() - self.HISTORY_DAYS * 86400,))
+        self.pruned_at = time.monotonic()
+
+    def is_empty(self) -> bool:
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM proxies LIMIT 1").fetchone() is None
+
+    def load(self) -> Tuple[List[ProxyRecord], Optional[ProxyRecord]]:
+        """Return the stored proxies and the current proxy"""
+        with self.lock:
+            rows = self.db.execute("""
+                SELECT type, host, port, source, latency, success_rate,
+                       last_checked, failure_streak, last_success
+                FROM proxies ORDER BY rowid
+            """).fetchall()
+            current = self.db.execute("SELECT value FROM state WHERE key = 'current_proxy'").fetchone()
+        proxies = [ProxyRecord(*row) for row in rows]
+        try:
+            current_proxy = ProxyRecord.from_dict(json.loads(current[0])) if current and current[0] else None
+        except (KeyError, TypeError, ValueError):
+            current_proxy = None
+        return proxies, current_proxy
+
+    def log_check(self, proxy: ProxyRecord, ok: bool, latency: Optional[float]) -> None:
+        """Queue a verification result for the history table, written on the next sync"""
+        with self.lock:
+            self.pending_checks.append((proxy.type, proxy.host, proxy.port, time.time(), int(ok), latency))
+
+    def sync(self, pool: ProxyPool, current_proxy: Optional[ProxyRecord]) -> None:
+        """Write the pool's changes, queued history and the current proxy in one transaction"""
+        changed, removed = pool.take_changes()
+        now = time.time()
+        with self.lock:
+            checks, self.pending_checks = self.pending_checks, []
+            self.db.execute("BEGIN")
+            try:
+                self.db.executemany("""
+                    INSERT INTO proxies (type, host, port, source, added_at, latency, success_rate,
+                                         failure_streak, last_checked, last_success)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (type, host, port) DO UPDATE SET
+                        source = COALESCE(excluded.source, proxies.source),
+                        latency = excluded.latency,
+                        success_rate = excluded.success_rate,
+                        failure_streak = excluded.failure_streak,
+                        last_checked = excluded.last_checked,
+                        last_success = excluded.last_success
+                """, [
+                    (proxy.type, proxy.host, proxy.port, proxy.source, now,
+                     proxy.latency, proxy.success_rate, proxy.failure_streak,
+                     proxy.last_checked, proxy.last_success)
+                    for proxy in changed
+                ])
+                self.db.executemany("DELETE FROM proxies WHERE type = ? AND host = ? AND port = ?", removed)
+                self.db.executemany("INSERT INTO checks VALUES (?, ?, ?, ?, ?, ?)", checks)
+                if time.monotonic() - self.pruned_at >= self.PRUNE_INTERVAL:
+                    self._prune()
+                self.db.execute(
+                    "INSERT OR REPLACE INTO state (key, value) VALUES ('current_proxy', ?)",
+                    (json.dumps(current_proxy.to_dict() if current_proxy else None),)
+                )
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.close()
+
+class UpstreamSessionPool:
+    """Keep-alive sessions per upstream proxy, shared by all handler threads"""
+
+    def __init__(self, pool_size: int = 32, idle_timeout: float = 60):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.sessions: Dict[str, Tuple[requests.Session, float]] = {}
+
+    def new_session(self, proxies: Dict[str, str]) -> requests.Session:
+        session = requests.Session()
+        session.proxies.update(proxies)
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=self.pool_size,
+            pool_maxsize=self.pool_size
+        )
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def session_for(self, proxies: Dict[str, str]) -> requests.Session:
+        """Return the warm session for this upstream, creating it if needed"""
+        key = proxies['http']
+        now = time.monotonic()
+        with self.lock:
+            self.evict_idle(now)
+            entry = self.sessions.get(key)
+            session = entry[0] if entry else self.new_session(proxies)
+            self.sessions[key] = (session, now)
+            return session
+
+    def evict_idle(self, now: float) -> None:
+        """Close sessions that have not been used for idle_timeout seconds"""
+        for key, (session, last_used) in list(self.sessions.items()):
+            if now - last_used > self.idle_timeout:
+                del self.sessions[key]
+                session.close()
+
+    def close(self, key: str) -> None:
+        """Drop the session of one upstream"""
+        with self.lock:
+            entry = self.sessions.pop(key, None)
+        if entry:
+            entry[0].close()
+
+class CircuitBreaker:
+    """Stop sending live traffic to an upstream that keeps failing
+
+    Closed, it lets everything through. `failures` failed requests or
+    timeouts in a row trip it open, and it turns traffic away for `cooldown`
+    seconds. It is then half-open: one request is let through as a probe,
+    closing the breaker if it works and opening it again if not.
+    """
+
+    def __init__(self, failures: int = 3, cooldown: float = 30.0, on_trip: Optional[Callable[[], None]] = None):
+        self.failures = max(1, failures)
+        self.cooldown = cooldown
+        self.on_trip = on_trip
+        self.lock = threading.Lock()
+        self.state = 'closed'
+        self.streak = 0
+        self.opened_at = 0.0
+        # Start of the half-open probe in flight, a probe that never reports back expires after the cooldown
+        self.probe_started: Optional[float] = None
+
+    def ready(self) -> bool:
+        """Whether a new request may be sent, without claiming the half-open probe"""
+        with self.lock:
+            if self.state == 'closed':
+                return True
+            now = time.monotonic()
+            if now - self.opened_at < self.cooldown:
+                return False
+            return self.probe_started is None or now - self.probe_started >= self.cooldown
+
+    def begin(self) -> None:
+        """Note that a request was sent, past the cooldown it becomes the half-open probe"""
+        with self.lock:
+            if self.state != 'closed':
+                self.state = 'half_open'
+                self.probe_started = time.monotonic()
+
+    def record(self, ok: bool, started: float) -> bool:
+        """Count the outcome of a request sent at `started`, True if it tripped the breaker"""
+        with self.lock:
+            if self.state == 'closed':
+                self.streak = 0 if ok else self.streak + 1
+                if self.streak < self.failures:
+                    return False
+            elif self.state == 'open' or started < self.probe_started:
+                # Only the probe decides, late answers to requests sent before it don't count
+                return False
+            elif ok:
+                self.state = 'closed'
+                self.streak = 0
+                self.probe_started = None
+                return False
+            # A failed probe opens the breaker again for another cooldown
+            self.state = 'open'
+            self.opened_at = time.monotonic()
+            self.probe_started = None
+        if self.on_trip:
+            self.on_trip()
+        return True
+
+class UpstreamUnavailable(ConnectionError):
+    """Every upstream has its circuit breaker open"""
+
+class Upstream:
+    """One upstream proxy as handed to the local server, with the connections still using it"""
+
+    def __init__(self, proxy: Optional[ProxyRecord], proxies: Dict[str, str],
+                 on_result: Optional[Callable[[bool, Optional[float]], None]] = None,
+                 breaker: Optional[CircuitBreaker] = None):
+        self.proxy = proxy
+        self.proxies = proxies
+        self.url = proxies['http']
+        # Names the upstream in logs, without the credentials a URL may carry
+        self.label = str(proxy) if proxy else 'tor'
+        # Metrics only tell proxies from Tor, a series per proxy would grow with every rotation
+        self.kind = 'tor' if proxy is None or isinstance(proxy, TorCircuit) else 'proxy'
+        self.on_result = on_result
+        self.breaker = breaker or CircuitBreaker()
+        self.lock = threading.Lock()
+        self.active = 0
+        # Callbacks that force-close a connection that outlives the drain grace period
+        self.closers: set = set()
+        self.draining = False
+        self.retired = False
+        # Running total of the smooth weighted round robin
+        self.current_weight = 0.0
+
+    def weight(self) -> float:
+        """Share of new connections under latency-weighted round robin, inverse to the latency"""
+        latency = self.proxy.latency if self.proxy and self.proxy.latency else ProxyRecord.default_latency
+        return 1.0 / max(latency, 0.01)
+
+    def failing(self) -> bool:
+        return self.proxy is not None and self.proxy.failure_streak > 0
+
+    def report(self, ok: bool, started: float) -> None:
+        """Score the upstream from a live request sent at `started`"""
+        latency = time.monotonic() - started
+        METRICS.add('proxy_anonymizer_upstream_requests_total', 1, (self.kind, 'ok' if ok else 'error'))
+        if ok:
+            METRICS.observe('proxy_anonymizer_upstream_latency_seconds', latency)
+        if self.breaker.record(ok, started):
+            METRICS.add('proxy_anonymizer_upstream_breaker_trips_total', 1, (self.kind,))
+            logging.warning(f"Circuit breaker of {self.label} tripped, sending its traffic elsewhere")
+        if self.on_result:
+            self.on_result(ok, latency if ok else None)
+
+    def track(self, closer: Callable[[], None]) -> None:
+        with self.lock:
+            self.closers.add(closer)
+
+    def untrack(self, closer: Callable[[], None]) -> None:
+        with self.lock:
+            self.closers.discard(closer)
+
+    def close_all(self) -> int:
+        """Force-close every tracked connection"""
+        with self.lock:
+            closers = list(self.closers)
+        for closer in closers:
+            try:
+                closer()
+            except Exception:
+                pass
+        return len(closers)
+
+class UpstreamSwitch:
+    """Atomically swap the upstreams of the local server
+
+    New requests and tunnels lease one of the current upstreams and keep it
+    until they finish, so a swap is one pointer change: new connections go
+    to the new upstreams at once while existing ones drain on the old ones.
+    Connections still open `grace` seconds after the swap are closed, and
+    an old upstream's keep-alive session once nothing uses it anymore.
+
+    With several upstreams each lease picks one by least connections or by
+    latency-weighted round robin, optionally sticking to the upstream a
+    destination host was last sent through.
+
+    Upstreams whose circuit breaker is open are passed over, and the
+    fallback (Tor) takes the traffic when all of them are. A request that
+    fails to reach its upstream within `connect_timeout`, or to get the
+    response head within `header_timeout`, moves on to the next one through
+    `failover`, as long as it is within `request_timeout` of its first try.
+    """
+
+    POLICIES = ('least_connections', 'weighted')
+    # Destination hosts remembered for stickiness, oldest are forgotten first
+    max_sticky_hosts = 4096
+    # Other upstreams a failed request is retried on
+    failover_attempts = 2
+    # Seconds a request may spend over all its attempts until the response head arrives
+    request_timeout = 15
+    # Seconds an upstream may take to start answering a request
+    header_timeout = 5
+
+    def __init__(self, sessions: Optional[UpstreamSessionPool] = None, grace: float = 30,
+                 policy: str = 'least_connections', sticky: bool = False, connect_timeout: float = 5):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown balancing policy: {policy}")
+        self.sessions = sessions
+        self.grace = grace
+        self.policy = policy
+        self.sticky = sticky
+        self.connect_timeout = connect_timeout
+        self.lock = threading.Lock()
+        self.current: Optional[Upstream] = None
+        self.upstreams: List[Upstream] = []
+        self.fallback: Optional[Upstream] = None
+        self.hosts: Dict[str, Upstream] = {}
+
+    def swap(self, proxy: Optional[ProxyRecord], proxies: Dict[str, str],
+             on_result: Optional[Callable[[bool, Optional[float]], None]] = None) -> None:
+        """Make a single new upstream current and start draining the previous ones"""
+        self.swap_all([Upstream(proxy, proxies, on_result)])
+
+    def swap_all(self, upstreams: List[Upstream], fallback: Optional[Upstream] = None) -> None:
+        """Balance new connections over `upstreams`, the first one is the primary
+
+        `fallback` is only used while every one of them has its breaker open.
+        """
+        with self.lock:
+            previous = {upstream.url: upstream for upstream in self.upstreams}
+            if self.fallback:
+                previous.setdefault(self.fallback.url, self.fallback)
+            # An upstream that stays keeps its connection count, round robin and breaker state
+            self.upstreams = [previous.pop(upstream.url, upstream) for upstream in upstreams]
+            self.current = self.upstreams[0]
+            if fallback and any(upstream.url == fallback.url for upstream in self.upstreams):
+                fallback = None
+            self.fallback = previous.pop(fallback.url, fallback) if fallback else None
+            if previous:
+                self.hosts = {host: upstream for host, upstream in self.hosts.items()
+                              if upstream.url not in previous}
+        for upstream in previous.values():
+            self.drain(upstream)
+
+    def pick(self, host: Optional[str], exclude: Iterable[Upstream] = ()) -> Upstream:
+        """Choose the upstream for a new connection, called with the lock held"""
+        ready = [upstream for upstream in self.upstreams
+                 if upstream not in exclude and upstream.breaker.ready()]
+        if not ready:
+            if self.fallback and self.fallback not in exclude and self.fallback.breaker.ready():
+                return self.fallback
+            raise UpstreamUnavailable("No upstream proxy is available")
+        if len(ready) == 1:
+            return ready[0]
+        if self.sticky and host:
+            upstream = self.hosts.get(host)
+            if upstream in ready and not upstream.failing():
+                return upstream
+        candidates = [upstream for upstream in ready if not upstream.failing()] or ready
+        if self.policy == 'weighted':
+            # Smooth weighted round robin, as in nginx: every upstream gains its
+            # weight, the leader is picked and pays back the total
+            total = 0.0
+            for upstream in candidates:
+                weight = upstream.weight()
+                upstream.current_weight += weight
+                total += weight
+            chosen = max(candidates, key=lambda upstream: upstream.current_weight)
+            chosen.current_weight -= total
+        else:
+            chosen = min(candidates, key=lambda upstream: upstream.active)
+        if self.sticky and host:
+            self.hosts.pop(host, None)
+            if len(self.hosts) >= self.max_sticky_hosts:
+                del self.hosts[next(iter(self.hosts))]
+            self.hosts[host] = chosen
+        return chosen
+
+    def acquire(self, host: Optional[str] = None, exclude: Iterable[Upstream] = ()) -> Upstream:
+        with self.lock:
+            upstream = self.pick(host, exclude)
+            upstream.breaker.begin()
+            with upstream.lock:
+                upstream.active += 1
+        return upstream
+
+    def release(self, upstream: Upstream) -> None:
+        with upstream.lock:
+            upstream.active -= 1
+            idle = upstream.draining and upstream.active == 0
+        if idle:
+            self.retire(upstream)
+
+    @contextlib.contextmanager
+    def lease(self, host: Optional[str] = None):
+        """Use one of the current upstreams for one request or tunnel to `host`"""
+        upstream = self.acquire(host)
+        try:
+            yield upstream
+        finally:
+            self.release(upstream)
+
+    @staticmethod
+    def time_left(deadline: float, limit: float) -> float:
+        """Timeout for one step of an attempt, `limit` at most and never past the request's deadline"""
+        return max(0.01, min(limit, deadline - time.monotonic()))
+
+    def failover(self, host: Optional[str], attempt: Callable[[Upstream, float], Any], retries: Optional[int] = None):
+        """Lease an upstream and run `attempt` on it, moving to the next one when it raises
+
+        `attempt` gets the upstream and the request's deadline, shared by all
+        attempts. Returns the upstream, still leased, and what `attempt`
+        returned. An attempt must not consume anything it cannot resend, so
+        pass `retries=0` for requests with a streamed body.
+        """
+        retries = self.failover_attempts if retries is None else retries
+        deadline = time.monotonic() + self.request_timeout
+        tried: List[Upstream] = []
+        while True:
+            upstream = self.acquire(host, tried)
+            started = time.monotonic()
+            try:
+                result = attempt(upstream, deadline)
+            except Exception:
+                upstream.report(False, started)
+                self.release(upstream)
+                tried.append(upstream)
+                if len(tried) > retries or time.monotonic() >= deadline:
+                    raise
+                METRICS.add('proxy_anonymizer_upstream_failovers_total')
+                continue
+            upstream.report(True, started)
+            return upstream, result
+
+    async def failover_async(self, host: Optional[str], attempt: Callable[[Upstream, float], Awaitable],
+                             retries: Optional[int] = None):
+        """Asyncio version of failover"""
+        retries = self.failover_attempts if retries is None else retries
+        deadline = time.monotonic() + self.request_timeout
+        tried: List[Upstream] = []
+        while True:
+            upstream = self.acquire(host, tried)
+            started = time.monotonic()
+            try:
+                result = await attempt(upstream, deadline)
+            except asyncio.CancelledError:
+                self.release(upstream)
+                raise
+            except Exception:
+                upstream.report(False, started)
+                self.release(upstream)
+                tried.append(upstream)
+                if len(tried) > retries or time.monotonic() >= deadline:
+                    raise
+                METRICS.add('proxy_anonymizer_upstream_failovers_total')
+                continue
+            upstream.report(True, started)
+            return upstream, result
+
+    def drain(self, upstream: Upstream) -> None:
+        with upstream.lock:
+            upstream.draining = True
+            idle = upstream.active == 0
+        if idle:
+            self.retire(upstream)
+            return
+        timer = threading.Timer(self.grace, self.expire, (upstream,))
+        timer.daemon = True
+        timer.start()
+
+    def expire(self, upstream: Upstream) -> None:
+        """Close what is left on a drained upstream after the grace period"""
+        if not upstream.retired:
+            closed = upstream.close_all()
+            METRICS.add('proxy_anonymizer_upstream_forced_closes_total', closed)
+            if closed:
+                logging.info(f"Closed {closed} connections still open on {upstream.url} after {self.grace}s")
+
+    def retire(self, upstream: Upstream) -> None:
+        with upstream.lock:
+            if upstream.retired:
+                return
+            upstream.retired = True
+        with self.lock:
+            # Rotating back to the same upstream keeps its warm session
+            in_use = any(current.url == upstream.url for current in self.upstreams + [self.fallback] if current)
+        if self.sessions and not in_use:
+            self.sessions.close(upstream.url)
+
+def raise_open_files_limit() -> None:
+    """Raise the soft limit on open files to the hard limit, once at startup
+
+    Mass verification keeps thousands of sockets open; everything that
+    waits on sockets uses selectors or asyncio, so descriptors above 1024
+    are fine.
+    """
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != resource.RLIM_INFINITY and (hard == resource.RLIM_INFINITY or soft < hard):
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+def max_open_sockets(reserve: int = 64) -> int:
+    """Return how many sockets this process can safely keep open at once, under the current limit"""
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft == resource.RLIM_INFINITY:
+            soft = hard if hard != resource.RLIM_INFINITY else 65536
+        return max(1, soft - reserve)
+    except Exception:
+        return 256
+
+async def cancel_tasks(tasks: List[asyncio.Future]) -> None:
+    """Cancel tasks and wait until every one of them has really stopped"""
+    # asyncio.wait_for can swallow a cancellation that races with its inner
+    # future completing, so keep cancelling until nothing is left running
+    while True:
+        running = [task for task in tasks if not task.done()]
+        if not running:
+            return
+        for task in running:
+            task.cancel()
+        await asyncio.wait(running, timeout=0.1)
+
+class AsyncProxyVerifier:
+    """Verify many proxies at once on a single asyncio event loop"""
+
+    def __init__(self, verify_url: str, concurrency: int = 500, timeout: float = 8.0,
+                 attempts: int = 1, fallback: Optional[Callable[[ProxyRecord], bool]] = None,
+                 connect_timeout: float = 3.0):
+        self.verify_url = verify_url
+        # Both stages run this many checks at once, so budget sockets for two
+        self.concurrency = max(1, min(concurrency, max_open_sockets() // 2))
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.attempts = max(1, attempts)
+        # Blocking checker used for proxy types the event loop can't speak
+        self.fallback = fallback
+        self.executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        self.checked = 0
+        self.skipped = 0
+        url = urlparse(verify_url)
+        self.verify_host = url.hostname
+        self.verify_port = url.port or 80
+        request = (
+            "GET {} HTTP/1.1\r\n"
+            f"Host: {url.netloc}\r\n"
+            f"User-Agent: {USER_AGENT}\r\n"
+            "Connection: close\r\n\r\n"
+        )
+        # HTTP proxies get the absolute URL, SOCKS tunnels talk to the origin directly
+        self.request = request.format(verify_url).encode()
+        self.origin_request = request.format(url.path or '/').encode()
+
+    async def tcp_check(self, proxy: ProxyRecord) -> bool:
+        """Check that the proxy port accepts TCP connections"""
+        try:
+            _, writer = await asyncio.wait_for(
+                asyncio.open_connection(proxy.host, proxy.port),
+                self.connect_timeout
+            )
+        except (OSError, ValueError, asyncio.TimeoutError):
+            return False
+        writer.close()
+        return True
+
+    async def http_check(self, proxy: ProxyRecord) -> bool:
+        """Fetch verify_url through the proxy and check for a 200 answer"""
+        if proxy.type in SOCKS_SCHEMES:
+            reader, writer = await open_tunnel_async(proxy.url, self.verify_host, self.verify_port)
+            request = self.origin_request
+        else:
+            reader, writer = await asyncio.open_connection(proxy.host, proxy.port)
+            request = self.request
+        try:
+            writer.write(request)
+            await writer.drain()
+            status_line = await reader.readline()
+            parts = status_line.split(None, 2)
+            return len(parts) >= 2 and parts[0].startswith(b'HTTP/') and parts[1] == b'200'
+        finally:
+            writer.close()
+
+    async def fallback_check(self, proxy: ProxyRecord) -> bool:
+        """Run the blocking fallback checker on the verifier's own thread pool"""
+        if not self.fallback:
+            return False
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=20)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.fallback, proxy)
+
+    async def check(self, proxy: ProxyRecord) -> Optional[float]:
+        """Return the round-trip time in seconds if the proxy works, None otherwise"""
+        for _ in range(self.attempts):
+            start = time.monotonic()
+            try:
+                if proxy.type in ('http', 'https') or proxy.type in SOCKS_SCHEMES:
+                    ok = await asyncio.wait_for(self.http_check(proxy), self.timeout)
+                else:
+                    ok = await asyncio.wait_for(self.fallback_check(proxy), self.timeout)
+            except (OSError, ValueError, IndexError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+                ok = False
+            if ok:
+                return time.monotonic() - start
+        return None
+
+    async def sweep(self, proxies: List[ProxyRecord], desired_quantity: Optional[int] = None,
+                    on_result: Optional[Callable[[ProxyRecord, Optional[float]], None]] = None,
+                    deadline: Optional[float] = None) -> List[ProxyRecord]:
+        """Two-stage verification: TCP pre-filter, then the full HTTP check on the survivors
+
+        Candidates are pulled from the list by a fixed number of workers, so at
+        most `concurrency` checks per stage are ever scheduled. The sweep stops
+        as soon as desired_quantity proxies work, the deadline passes or it is
+        cancelled; checks that never ran are counted in `skipped`.
+        """
+        pending = iter(proxies)
+        reachable: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency)
+        working = []
+        finished = asyncio.Event()
+        self.checked = 0
+        self.skipped = 0
+
+        def record(proxy: ProxyRecord, latency: Optional[float], failure: str = 'failed') -> None:
+            if finished.is_set():
+                return
+            self.checked += 1
+            METRICS.add('proxy_anonymizer_verifications_total', 1, ('ok' if latency is not None else failure,))
+            if latency is not None:
+                METRICS.observe('proxy_anonymizer_verification_seconds', latency)
+            if latency is not None:
+                working.append(proxy)
+            if on_result:
+                on_result(proxy, latency)
+            if desired_quantity and len(working) >= desired_quantity:
+                finished.set()
+
+        async def connect_worker():
+            for proxy in pending:
+                if finished.is_set():
+                    return
+                if await self.tcp_check(proxy):
+                    await reachable.put(proxy)
+                else:
+                    record(proxy, None, 'unreachable')
+
+        async def check_worker():
+            while True:
+                proxy = await reachable.get()
+                if proxy is None:
+                    return
+                record(proxy, await self.check(proxy))
+
+        async def pipeline():
+            connectors = [asyncio.ensure_future(connect_worker()) for _ in range(self.concurrency)]
+            checkers = [asyncio.ensure_future(check_worker()) for _ in range(self.concurrency)]
+            try:
+                await asyncio.gather(*connectors)
+                for _ in checkers:
+                    await reachable.put(None)
+                await asyncio.gather(*checkers)
+            finally:
+                await cancel_tasks(connectors + checkers)
+            finished.set()
+
+        runner = asyncio.ensure_future(pipeline())
+        waiter = asyncio.ensure_future(finished.wait())
+        try:
+            done, _ = await asyncio.wait({runner, waiter}, timeout=deadline,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                raise asyncio.TimeoutError()
+        finally:
+            finished.set()
+            await cancel_tasks([runner, waiter])
+            if self.executor:
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = None
+            self.skipped = len(proxies) - self.checked
+        return working
+
+    def run(self, proxies: List[ProxyRecord], **kwargs) -> List[ProxyRecord]:
+        """Blocking wrapper around sweep"""
+        return asyncio.run(self.sweep(proxies, **kwargs))
+
+class HealthChecker:
+    """Re-verify pooled proxies in the background on adaptive intervals
+
+    Every proxy sits in a heap ordered by its next check time. Reliable, fast
+    proxies are checked rarely, flaky ones often, and a failing proxy backs off
+    exponentially until evict_after failures in a row drop it from the pool.
+    A token bucket caps the checks started per second across the whole pool.
+    """
+
+    tick = 1.0  # Seconds between scheduling rounds
+    rescan_interval = 10.0  # Seconds between looks for proxies added to the pool
+
+    def __init__(self, pool: ProxyPool, make_verifier: Callable[[int], 'AsyncProxyVerifier'],
+                 on_result: Optional[Callable[[ProxyRecord, bool, Optional[float]], None]] = None,
+                 checks_per_second: float = 20, min_interval: float = 60, max_interval: float = 3600,
+                 evict_after: int = 5):
+        self.pool = pool
+        self.make_verifier = make_verifier
+        self.on_result = on_result
+        self.checks_per_second = max(0.1, checks_per_second)
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.evict_after = evict_after
+        self.queue: List[Tuple[float, int, ProxyRecord]] = []
+        self.scheduled: set = set()
+        self.counter = 0  # Tie breaker so the heap never compares proxy dicts
+        self.checks = 0
+        self.evicted = 0
+        self.stopping = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def interval(self, proxy: ProxyRecord) -> float:
+        """Seconds until the proxy should be checked again"""
+        if proxy.last_checked is None:
+            return 0
+        if proxy.failure_streak:
+            return min(self.min_interval * 2 ** (proxy.failure_streak - 1), self.max_interval)
+        latency = proxy.latency if proxy.latency is not None else ProxyRecord.default_latency
+        # Trust grows with the success rate and shrinks with latency
+        trust = proxy.success_rate ** 2 / (1 + latency)
+        return self.min_interval + (self.max_interval - self.min_interval) * trust
+
+    def schedule(self, proxy: ProxyRecord) -> None:
+        """Queue the proxy's next check, spread by a little jitter so checks don't bunch up"""
+        due = (proxy.last_checked or 0) + self.interval(proxy) * random.uniform(0.9, 1.1)
+        self.counter += 1
+        heapq.heappush(self.queue, (due, self.counter, proxy))
+        self.scheduled.add(proxy)
+
+    def rescan(self) -> None:
+        """Schedule proxies that joined the pool since the last scan"""
+        for proxy in self.pool:
+            if proxy not in self.scheduled:
+                self.schedule(proxy)
+
+    def due(self, limit: int) -> List[ProxyRecord]:
+        """Pop up to `limit` proxies whose check is due, forgetting ones that left the pool"""
+        now = time.time()
+        batch = []
+        while self.queue and len(batch) < limit and self.queue[0][0] <= now:
+            _, _, proxy = heapq.heappop(self.queue)
+            self.scheduled.discard(proxy)
+            if proxy in self.pool:
+                batch.append(proxy)
+        return batch
+
+    def check(self, batch: List[ProxyRecord]) -> None:
+        """Verify a batch and reschedule or evict each proxy by its result"""
+        def on_result(proxy: ProxyRecord, latency: Optional[float]) -> None:
+            self.checks += 1
+            if self.on_result:
+                self.on_result(proxy, latency is not None, latency)
+            else:
+                self.pool.record(proxy, latency is not None, latency)
+
+        try:
+            asyncio.run(self.sweep(self.make_verifier(len(batch)), batch, on_result))
+        except asyncio.TimeoutError:
+            pass
+        if self.stopping.is_set():
+            return  # Unchecked proxies are picked up again by the next checker's rescan
+        for proxy in batch:
+            if proxy.failure_streak >= self.evict_after:
+                if self.pool.remove(proxy):
+                    self.evicted += 1
+                    logging.info(f"Evicted dead proxy {proxy.host}:{proxy.port} after {proxy.failure_streak} failed checks")
+            elif proxy in self.pool:
+                self.schedule(proxy)
+
+    async def sweep(self, verifier: 'AsyncProxyVerifier', batch: List[ProxyRecord],
+                    on_result: Callable[[ProxyRecord, Optional[float]], None]) -> None:
+        """Run the verifier over a batch, cancelled as soon as the checker is asked to stop"""
+        sweep = asyncio.ensure_future(verifier.sweep(
+            batch, on_result=on_result,
+            deadline=verifier.connect_timeout + verifier.timeout * verifier.attempts + 1
+        ))
+        try:
+            while not self.stopping.is_set():
+                done, _ = await asyncio.wait({sweep}, timeout=0.1)
+                if done:
+                    sweep.result()
+                    return
+        finally:
+            await cancel_tasks([sweep])
+
+    def run(self) -> None:
+        tokens = self.checks_per_second
+        last_refill = last_rescan = time.monotonic()
+        self.rescan()
+        while not self.stopping.is_set():
+            now = time.monotonic()
+            # Budget at most one second of checks, idle time doesn't pile up into a burst
+            tokens = min(self.checks_per_second, tokens + (now - last_refill) * self.checks_per_second)
+            last_refill = now
+            if now - last_rescan >= self.rescan_interval:
+                self.rescan()
+                last_rescan = now
+            batch = self.due(int(tokens))
+            if batch:
+                tokens -= len(batch)
+                try:
+                    self.check(batch)
+                except Exception as e:
+                    logging.error(f"Health check error: {e}")
+                    for proxy in batch:
+                        self.schedule(proxy)
+            self.stopping.wait(self.tick)
+
+    def start(self) -> None:
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopping.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+class SourceCache:
+    """On-disk cache of scraped proxy lists with their HTTP validators"""
+
+    def __init__(self, directory: Path, ttl: float):
+        self.directory = directory
+        self.ttl = ttl
+
+    def path(self, name: str) -> Path:
+        return self.directory / f"{hashlib.sha1(name.encode()).hexdigest()}.json"
+
+    def load(self, name: str) -> Dict:
+        try:
+            with open(self.path(name), 'r') as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return {}
+
+    def save(self, name: str, entry: Dict) -> None:
+        path = self.path(name)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix('.tmp')
+            with open(tmp_path, 'w') as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.error(f"Failed to cache proxies from {name}: {e}")
+
+class EnvironmentCache:
+    """On-disk cache of slow environment probes, dropped when the OS, Python or PATH change"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.values: Optional[Dict] = None
+
+    @staticmethod
+    def fingerprint() -> str:
+        parts = [sys.executable, sys.version, os.environ.get('PATH', '')]
+        for name in ('/etc/os-release', '/usr/lib/os-release'):
+            try:
+                parts.append(str(os.stat(name).st_mtime_ns))
+            except OSError:
+                pass
+        return hashlib.sha1('\0'.join(parts).encode()).hexdigest()
+
+    def load(self) -> None:
+        try:
+            with open(self.path, 'r') as f:
+                entry = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            entry = {}
+        self.values = entry.get('values', {}) if entry.get('fingerprint') == self.fingerprint() else {}
+
+    def save(self) -> None:
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_suffix('.tmp')
+            with open(tmp_path, 'w') as f:
+                json.dump({'fingerprint': self.fingerprint(), 'values': self.values}, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.debug(f"Failed to cache environment probes: {e}")
+
+    def get(self, name: str, probe: Callable[[], object]):
+        """Cached result of `probe`, running it only when there is none"""
+        if self.values is None:
+            self.load()
+        if name not in self.values:
+            self.values[name] = probe()
+            self.save()
+        return self.values[name]
+
+class ProxySource:
+    """A place proxies are scraped from
+
+    Subclasses only implement parse(); fetching with conditional requests
+    and caching is shared.
+    """
+
+    def __init__(self, url: str, type: str = 'http'):
+        self.url = url
+        self.type = type
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.url!r})"
+
+    def parse(self, text: str) -> List[Dict[str, str]]:
+        raise NotImplementedError
+
+    def proxy(self, host: str, port, proxy_type: Optional[str] = None) -> Dict[str, str]:
+        return {'type': proxy_type or self.type, 'host': host, 'port': str(port), 'source': self.url}
+
+    def fetch(self, cache: SourceCache) -> List[Dict[str, str]]:
+        """Fetch the source, reusing the cached parse while it is fresh or unchanged"""
+        cached = cache.load(self.url)
+        if cached and time.time() - cached.get('fetched_at', 0) < cache.ttl:
+            return cached['proxies']
+
+        headers = {
+            'User-Agent': USER_AGENT
+        }
+        # Conditional request, an unchanged page costs a 304 and no parsing
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+
         try:
-            self.send_response(code)
-            self.send_header('Connection', 'close')
-            self.end_headers()
-        except Exception:
-            pass
+            response = requests.get(self.url, headers=headers, timeout=10)
+            if response.status_code == 304 and cached:
+                cached['fetched_at'] = time.time()
+                cache.save(self.url, cached)
+                return cached['proxies']
+            response.raise_for_status()
+            proxies = self.parse(response.text)
+        except Exception as e:
+            logging.error(f"Failed to fetch proxies from {self.url}: {e}")
+            # A stale list is better than none
+            return cached.get('proxies', [])
 
-    def do_CONNECT(self):
-        """Handle CONNECT requests"""
+        cache.save(self.url, {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'fetched_at': time.time(),
+            'proxies': proxies
+        })
+        return proxies
+
+class HtmlTableSource(ProxySource):
+    """HTML page listing proxies as table rows with the IP and port in the first two cells"""
+
+    ROW_PATTERN = re.compile(
+        r'<tr[^>]*>\s*<td[^>]*>\s*([0-9a-fA-F.:\[\]]+)\s*</td>\s*<td[^>]*>\s*(\d{1,5})\s*</td>',
+        re.IGNORECASE
+    )
+
+    def parse(self, text: str) -> List[Dict[str, str]]:
+        proxies = [self.proxy(host, port) for host, port in self.ROW_PATTERN.findall(text)]
+        if proxies:
+            return proxies
+        # Markup the regex can't follow, take the slow but forgiving route
+        return self.parse_with_soup(text)
+
+    def parse_with_soup(self, text: str) -> List[Dict[str, str]]:
+        # Imported here, bs4 is slow to load and most pages never get this far
+        from bs4 import BeautifulSoup
+        proxies = []
+        soup = BeautifulSoup(text, 'html.parser')
+        table = soup.find('table')
+
+        if table:
+            for row in table.find_all('tr')[1:]:  # Skip header row
+                cols = row.find_all('td')
+                if len(cols) >= 2:
+                    proxies.append(self.proxy(cols[0].text.strip(), cols[1].text.strip()))
+        return proxies
+
+class PlainTextSource(ProxySource):
+    """Plain text list with one ip:port per line, optionally prefixed with a scheme"""
+
+    LINE_PATTERN = re.compile(r'(?:(https?|socks[45]h?|socks4a)://)?(\d{1,3}(?:\.\d{1,3}){3}):(\d{1,5})')
+
+    def parse(self, text: str) -> List[Dict[str, str]]:
+        return [
+            self.proxy(host, port, scheme or None)
+            for scheme, host, port in self.LINE_PATTERN.findall(text)
+        ]
+
+class JsonApiSource(ProxySource):
+    """JSON API answering with a list of proxy objects
+
+    `items` is the dotted path to the list in the document, the field
+    options name the keys holding the host, port and optional type.
+    """
+
+    def __init__(self, url: str, type: str = 'http', items: str = '', host_field: str = 'ip',
+                 port_field: str = 'port', type_field: Optional[str] = None):
+        super().__init__(url, type)
+        self.items = items
+        self.host_field = host_field
+        self.port_field = port_field
+        self.type_field = type_field
+
+    def parse(self, text: str) -> List[Dict[str, str]]:
+        data = json.loads(text)
+        for key in filter(None, self.items.split('.')):
+            data = data[key]
+        proxies = []
+        for item in data:
+            try:
+                proxy_type = item.get(self.type_field) if self.type_field else None
+                if isinstance(proxy_type, list):
+                    proxy_type = proxy_type[0] if proxy_type else None
+                proxies.append(self.proxy(item[self.host_field], item[self.port_field], proxy_type))
+            except (KeyError, TypeError, AttributeError):
+                continue
+        return proxies
+
+class FileSource(ProxySource):
+    """Local file, either JSON proxy entries or an ip:port text list, for offline use"""
+
+    def __init__(self, path: str, type: str = 'http'):
+        super().__init__(os.path.expanduser(path), type)
+
+    def parse(self, text: str) -> List[Dict[str, str]]:
+        if self.url.endswith('.json'):
+            entries = json.loads(text)
+            if isinstance(entries, dict):
+                entries = entries.get('proxy_list', [])
+            return [
+                self.proxy(entry['host'], entry['port'], entry.get('type'))
+                for entry in entries if isinstance(entry, dict)
+            ]
+        return PlainTextSource(self.url, self.type).parse(text)
+
+    def fetch(self, cache: SourceCache) -> List[Dict[str, str]]:
         try:
-            # Parse the host and port from the path
-            host, port = self.path.split(':')
-            port = int(port)
+            with open(self.url, 'r') as f:
+                return self.parse(f.read())
+        except (OSError, ValueError, KeyError) as e:
+            logging.error(f"Failed to read proxies from {self.url}: {e}")
+            return []
 
-            # Create a socket to the target server through the proxy
-            target_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            
-            # Connect to the proxy first
-            proxy_host, proxy_port = self.proxies['http'].split('://')[1].split(':')
-            target_socket.connect((proxy_host, int(proxy_port)))
-            
-            # Send CONNECT request to the proxy
-            connect_request = f"CONNECT {host}:{port} HTTP/1.1\r\nHost: {host}:{port}\r\n\r\n"
-            target_socket.send(connect_request.encode())
-            
-            # Read proxy response
-            response = target_socket.recv(4096)
-            if not response.startswith(b'HTTP/1.1 200'):
-                raise Exception("Proxy connection failed")
-            
-            # Send 200 Connection established to client
-            self.send_response(200, 'Connection established')
-            self.send_header('Connection', 'close')
-            self.end_headers()
+PROXY_SOURCE_KINDS = {
+    'html_table': HtmlTableSource,
+    'text': PlainTextSource,
+    'json': JsonApiSource,
+    'file': FileSource
+}
 
-            # Create a tunnel between the client and target
-            self.tunnel(target_socket)
-        except Exception:
-            self.send_error(500)
+DEFAULT_PROXY_SOURCES = [
+    {"kind": "html_table", "url": "https://proxy-list.net/", "type": "http"},
+    {"kind": "html_table", "url": "https://www.sslproxies.org/", "type": "https"},
+    {"kind": "html_table", "url": "https://www.us-proxy.org/", "type": "http"}
+]
 
-    def tunnel(self, target_socket):
-        """Create a tunnel between client and target"""
+def make_proxy_source(spec: Dict) -> ProxySource:
+    """Build a source from its config entry, e.g. {"kind": "text", "url": "..."}"""
+    options = dict(spec)
+    kind = options.pop('kind')
+    if kind not in PROXY_SOURCE_KINDS:
+        raise ValueError(f"unknown source kind {kind!r}")
+    return PROXY_SOURCE_KINDS[kind](**options)
+
+class TorController:
+    """Client for the Tor control port that stays connected between commands
+
+    Authenticates with whatever PROTOCOLINFO says the daemon accepts (no
+    auth, SAFECOOKIE, COOKIE or a control password) and subscribes to CIRC
+    events, so a new identity is reported as soon as a fresh circuit is built
+    instead of after a fixed sleep.
+    """
+
+    newnym_interval = 10  # Tor ignores NEWNYM signals sent closer together than this
+
+    def __init__(self, port: int = 9051, host: str = '127.0.0.1', password: str = '', timeout: float = 5.0):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.timeout = timeout
+        self.sock: Optional[socket.socket] = None
+        self.buffer = b''
+        self.lock = threading.Lock()
+        self.last_newnym = -float(self.newnym_interval)
+
+    def connect(self) -> None:
+        self.close()
+        self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
         try:
-            # Get the client socket
-            client_socket = self.connection
+            self.authenticate()
+            self.command('SETEVENTS CIRC')
+        except Exception:
+            self.close()
+            raise
 
-            # Set up the tunnel
-            while True:
-                # Check if client socket is readable
-                r, w, x = select.select([client_socket, target_socket], [], [])
-                if client_socket in r:
-                    data = client_socket.recv(8192)
-                    if not data:
-                        break
-                    target_socket.send(data)
-                if target_socket in r:
-                    data = target_socket.recv(8192)
-                    if not data:
+    def close(self) -> None:
+        if self.sock:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+        self.buffer = b''
+
+    def read_line(self, deadline: float) -> str:
+        while b'\r\n' not in self.buffer:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout("Tor control port timed out")
+            self.sock.settimeout(remaining)
+            data = self.sock.recv(4096)
+            if not data:
+                raise ConnectionError("Tor closed the control connection")
+            self.buffer += data
+        line, self.buffer = self.buffer.split(b'\r\n', 1)
+        return line.decode('utf-8', 'replace')
+
+    def read_reply(self, deadline: float) -> Tuple[str, List[str]]:
+        """Read one reply or asynchronous event (code 650) and return its code and lines"""
+        lines = []
+        while True:
+            line = self.read_line(deadline)
+            code, separator, text = line[:3], line[3:4], line[4:]
+            if separator == '+':
+                # Data block, ends with a lone dot and has leading dots doubled
+                data = []
+                while True:
+                    data_line = self.read_line(deadline)
+                    if data_line == '.':
                         break
-                    client_socket.send(data)
-        except Exception:
-            pass
-        finally:
-            target_socket.close()
+                    data.append(data_line[1:] if data_line.startswith('..') else data_line)
+                text = '\n'.join([text] + data)
+            lines.append(text)
+            if separator == ' ':
+                return code, lines
 
-    def do_GET(self):
-        try:
-            # Get the full URL
-            url = self.path
-            if not url.startswith('http'):
-                url = 'http://' + self.headers.get('Host', '') + url
-            
-            # Forward the request through the current proxy
-            response = requests.get(
-                url, 
-                proxies=self.proxies, 
-                timeout=10,
-                headers={'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
+    def command(self, line: str) -> List[str]:
+        """Send a command and return the lines of its 250 reply"""
+        self.sock.sendall(line.encode() + b'\r\n')
+        deadline = time.monotonic() + self.timeout
+        while True:
+            code, lines = self.read_reply(deadline)
+            if code == '650':
+                continue  # Event that arrived ahead of the reply
+            if code != '250':
+                raise ConnectionError(f"Tor control error {code}: {' '.join(lines)}")
+            return lines
+
+    def authenticate(self) -> None:
+        info = ' '.join(self.command('PROTOCOLINFO 1'))
+        match = re.search(r'METHODS=(\S+)', info)
+        methods = set(match.group(1).split(',')) if match else set()
+        if 'NULL' in methods:
+            self.command('AUTHENTICATE')
+            return
+
+        cookie = None
+        match = re.search(r'COOKIEFILE="((?:[^"\\]|\\.)*)"', info)
+        if match and methods & {'SAFECOOKIE', 'COOKIE'}:
+            try:
+                cookie = Path(re.sub(r'\\(.)', r'\1', match.group(1))).read_bytes()
+            except OSError as e:
+                logging.debug(f"Can't read Tor auth cookie: {e}")
+
+        if cookie and 'SAFECOOKIE' in methods:
+            # Prove knowledge of the cookie without sending it, and check Tor knows it too
+            client_nonce = os.urandom(32)
+            reply = ' '.join(self.command(f'AUTHCHALLENGE SAFECOOKIE {client_nonce.hex()}'))
+            fields = dict(re.findall(r'(\w+)=([0-9A-Fa-f]+)', reply))
+            message = cookie + client_nonce + bytes.fromhex(fields['SERVERNONCE'])
+            server_hash = hmac.new(b"Tor safe cookie authentication server-to-controller hash",
+                                   message, hashlib.sha256).hexdigest()
+            if not hmac.compare_digest(server_hash, fields['SERVERHASH'].lower()):
+                raise ConnectionError("Tor control port failed the SAFECOOKIE server check")
+            client_hash = hmac.new(b"Tor safe cookie authentication controller-to-server hash",
+                                   message, hashlib.sha256).hexdigest()
+            self.command(f'AUTHENTICATE {client_hash}')
+        elif cookie and 'COOKIE' in methods:
+            self.command(f'AUTHENTICATE {cookie.hex()}')
+        elif self.password and 'HASHEDPASSWORD' in methods:
+            escaped = self.password.replace('\\', '\\\\').replace('"', '\\"')
+            self.command(f'AUTHENTICATE "{escaped}"')
+        else:
+            raise ConnectionError(
+                f"no usable Tor control authentication (offered: {', '.join(sorted(methods)) or 'none'}), "
+                "make the auth cookie readable or set tor_control_password"
             )
-            
-            self.send_response(response.status_code)
-            for key, value in response.headers.items():
-                self.send_header(key, value)
-            self.end_headers()
-            self.wfile.write(response.content)
-        except Exception:
-            self.send_error(500)
 
-    def do_POST(self):
+    def wait_for_circuit(self, timeout: float) -> bool:
+        """Wait for Tor to report a newly built circuit"""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                code, lines = self.read_reply(deadline)
+            except socket.timeout:
+                return False
+            event = lines[0].split()
+            if code == '650' and len(event) >= 3 and event[0] == 'CIRC' and event[2] == 'BUILT':
+                return True
+
+    def request(self, line: str) -> List[str]:
+        """Run a command, connecting first and retrying once in case Tor was restarted under us"""
+        for attempt in range(2):
+            try:
+                if self.sock is None:
+                    self.connect()
+                return self.command(line)
+            except OSError:
+                self.close()
+                if attempt:
+                    raise
+
+    def bootstrap_progress(self) -> int:
+        """How far Tor got building its first circuits, 100 when it is ready"""
+        with self.lock:
+            match = re.search(r'PROGRESS=(\d+)', ' '.join(self.request('GETINFO status/bootstrap-phase')))
+            return int(match.group(1)) if match else 0
+
+    def new_identity(self, wait: float = 5.0) -> bool:
+        """Switch Tor to clean circuits, returns False while its NEWNYM rate limit applies"""
+        with self.lock:
+            if time.monotonic() - self.last_newnym < self.newnym_interval:
+                return False
+            self.request('SIGNAL NEWNYM')
+            self.last_newnym = time.monotonic()
+            if wait:
+                self.wait_for_circuit(wait)
+            return True
+
+class TorCircuit(ProxyRecord):
+    """A Tor SOCKS port used as an upstream proxy
+
+    Tor puts streams with different SOCKS credentials on different circuits
+    (IsolateSOCKSAuth, on by default), so an isolated lane moves to a fresh
+    circuit just by changing its username. A lane without isolation falls
+    back to NEWNYM, which resets every circuit of that Tor.
+    """
+
+    __slots__ = ('lane', 'generation', 'controller')
+
+    def __init__(self, port: int, controller: TorController, lane: Optional[int] = None, host: str = '127.0.0.1'):
+        super().__init__('socks5', host, port, source='tor')
+        self.lane = lane
+        self.generation = 0
+        self.controller = controller
+        self.set_url()
+
+    def set_url(self) -> None:
+        if self.lane is not None:
+            self._url = f"socks5h://lane{self.lane}-{self.generation}:tor@{self.host}:{self.port}"
+
+    @property
+    def key(self) -> Tuple:
+        return (self.type, self.host, self.port, self.lane)
+
+    def __str__(self) -> str:
+        lane = f" lane {self.lane}" if self.lane is not None else ""
+        return f"tor://{self.host}:{self.port}{lane}"
+
+    def renew(self) -> bool:
+        """Move to a new circuit, returns False if Tor's rate limit kept the old one"""
+        if self.lane is None:
+            return self.controller.new_identity()
+        self.generation += 1
+        self.set_url()
+        return True
+
+class TorPool:
+    """Tor circuits to balance over, on the system Tor and on Tor instances of our own
+
+    Every Tor gets `lanes` isolated circuits (0 disables isolation). Extra
+    instances, each with its own data directory and ports, add bandwidth
+    since a single Tor process does its crypto on one core.
+    """
+
+    bootstrap_timeout = 90  # Seconds a new instance gets to build its first circuit
+
+    def __init__(self, data_dir: Path, socks_port: int = 9050, control_port: int = 9051,
+                 password: str = '', instances: int = 0, lanes: int = 4, base_port: int = 9060):
+        self.data_dir = data_dir
+        self.socks_port = socks_port
+        self.control_port = control_port
+        self.password = password
+        self.instances = instances
+        self.lanes = lanes
+        self.base_port = base_port
+        self.processes: List[subprocess.Popen] = []
+        self.circuits: List[TorCircuit] = []
+
+    def add_circuits(self, socks_port: int, controller: TorController) -> None:
+        if self.lanes <= 0:
+            self.circuits.append(TorCircuit(socks_port, controller))
+        for lane in range(self.lanes):
+            self.circuits.append(TorCircuit(socks_port, controller, len(self.circuits)))
+
+    def launch(self, number: int) -> Tuple[int, TorController]:
+        """Start Tor instance `number`, returns its SOCKS port and controller"""
+        socks_port = self.base_port + 2 * number
+        control_port = socks_port + 1
+        data_dir = self.data_dir / str(number)
+        data_dir.mkdir(parents=True, exist_ok=True)
+        os.chmod(data_dir, 0o700)  # Tor refuses data directories others can read
+        self.processes.append(subprocess.Popen(
+            [
+                'tor',
+                '--SocksPort', f'127.0.0.1:{socks_port}',
+                '--ControlPort', f'127.0.0.1:{control_port}',
+                '--CookieAuthentication', '1',
+                '--DataDirectory', str(data_dir),
+                '--RunAsDaemon', '0'
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        ))
+        return socks_port, TorController(control_port)
+
+    def wait_ready(self, controllers: List[TorController]) -> int:
+        """Wait until the instances finished bootstrapping, returns how many did"""
+        deadline = time.monotonic() + self.bootstrap_timeout
+        pending = list(controllers)
+        while pending and time.monotonic() < deadline:
+            for controller in list(pending):
+                try:
+                    if controller.bootstrap_progress() >= 100:
+                        pending.remove(controller)
+                except OSError:
+                    pass  # Control port not open yet
+            if pending:
+                time.sleep(0.5)
+        return len(controllers) - len(pending)
+
+    def start(self) -> None:
+        # Our own instances come on top of the system Tor, which keeps its lanes
+        self.add_circuits(self.socks_port, TorController(self.control_port, password=self.password))
+        if not self.instances:
+            return
         try:
-            # Get the full URL
-            url = self.path
-            if not url.startswith('http'):
-                url = 'http://' + self.headers.get('Host', '') + url
+            launched = [self.launch(number) for number in range(self.instances)]
+        except OSError as e:
+            logging.error(f"Failed to start Tor instances, using the system Tor only: {e}")
+            self.terminate()
+            return
+        ready = self.wait_ready([controller for _, controller in launched])
+        logging.info(f"{ready} of {self.instances} Tor instances ready")
+        for socks_port, controller in launched:
+            self.add_circuits(socks_port, controller)
 
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            
-            # Forward the request through the current proxy
-            response = requests.post(
-                url, 
-                data=post_data, 
-                proxies=self.proxies, 
-                timeout=10,
-                headers={'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
-            )
-            
-            self.send_response(response.status_code)
-            for key, value in response.headers.items():
-                self.send_header(key, value)
-            self.end_headers()
-            self.wfile.write(response.content)
-        except Exception:
-            self.send_error(500)
+    def stop(self) -> None:
+        for circuit in self.circuits:
+            circuit.controller.close()
+        self.terminate()
+        self.circuits = []
 
-class ThreadedHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
-    """Handle requests in a separate thread."""
-    pass
+    def terminate(self) -> None:
+        """Stop the Tor instances we launched"""
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        self.processes = []
+
+    def select(self, k: int = 2) -> Optional[TorCircuit]:
+        """Pick the best scoring of k random circuits"""
+        if not self.circuits:
+            return None
+        return min(random.sample(self.circuits, min(k, len(self.circuits))), key=ProxyRecord.score)
 
 class ProxyAnonymizer:
-    def __init__(self):
-        self.proxy_list: List[Dict[str, str]] = []
-        self.current_proxy: Optional[Dict[str, str]] = None
+    # Tunables that can be overridden from the "settings" section of the config file, with their types
+    SETTINGS = {
+        "verify_concurrency": int,
+        "verify_timeout": float,
+        "upstream_pool_size": int,
+        "upstream_idle_timeout": float,
+        "upstream_drain_timeout": float,
+        "upstream_connect_timeout": float,
+        "breaker_failures": int,
+        "breaker_cooldown": float,
+        "balance_proxies": int,
+        "balance_policy": str,
+        "sticky_hosts": bool,
+        "local_port": int,
+        "rotation_delay": int,
+        "server_mode": str,
+        "max_connections": int,
+        "source_cache_ttl": float,
+        "health_checks_per_second": float,
+        "health_min_interval": float,
+        "health_max_interval": float,
+        "health_evict_after": int,
+        "tor_control_password": str,
+        "tor_instances": int,
+        "tor_lanes": int,
+        "tor_base_port": int
+    }
+
+    def __init__(self, config_file: Optional[Path] = None, overrides: Optional[Dict] = None):
+        self.proxy_pool = ProxyPool()
+        self.current_proxy: Optional[ProxyRecord] = None
         self.verify_url = "http://checkip.amazonaws.com"
-        self.config_file = Path.home() / ".proxy_anonymizer_config.json"
+        self.config_file = Path(config_file) if config_file else Path.home() / ".proxy_anonymizer_config.json"
+        # Settings given on the command line, they win over the config file and survive reloads
+        self.overrides = overrides or {}
+        # Settings as written in the config file, the only ones saved back to it
+        self.file_settings: Dict = {}
+        self.db_file = Path.home() / ".proxy_anonymizer.db"
+        self.cache_dir = Path.home() / ".cache" / "proxy-anonymizer"
         self.tor_port = 9050  # Default Tor SOCKS port
         self.tor_control_port = 9051  # Default Tor control port
+        self.tor_control_password = ""  # Only needed when Tor's auth cookie isn't readable
+        self.tor_instances = 0  # Tor processes of our own, 0 uses only the system Tor
+        self.tor_lanes = 4  # Isolated circuits per Tor, 0 rotates with NEWNYM instead
+        self.tor_base_port = 9060  # First SOCKS port of our own Tor instances, control port is +1
+        self.tor_pool: Optional[TorPool] = None
+        # Keeps a background rotation step from starting Tor again while rotation stops
+        self.rotation_lock = threading.Lock()
+        self.rotating = False
+        # Set when the current upstream's breaker trips, cuts the wait for the next rotation short
+        self.rotate_now = threading.Event()
+        # Seconds before a rotation that the next upstream is verified and warmed, so it is fresh when swapped in
+        self.prepare_lead = 30
         self.local_proxy_server = None
-        self.os_type = self.detect_os()
+        self.verify_concurrency = 500  # Checks kept in flight by the async verifier
+        self.verify_timeout = 8.0  # Deadline for a single proxy check in seconds
+        self.upstream_pool_size = 32  # Keep-alive connections per upstream proxy
+        self.upstream_idle_timeout = 60.0  # Seconds before an unused upstream pool is closed
+        self.upstream_drain_timeout = 30.0  # Seconds connections may stay on the previous upstream after a rotation
+        self.upstream_connect_timeout = 5.0  # Seconds to reach an upstream before trying the next one
+        self.breaker_failures = 3  # Failed requests in a row before traffic is taken off an upstream
+        self.breaker_cooldown = 30.0  # Seconds before a tripped upstream gets a probe request
+        self.balance_proxies = 0  # Spread connections over this many of the best proxies, 0 uses one at a time
+        self.balance_policy = "least_connections"  # Or "weighted": round robin weighted by latency
+        self.sticky_hosts = False  # Keep sending a destination host through the same proxy
+        self.local_port = 5005  # Port of the local proxy server
+        self.rotation_delay = 0  # Seconds between rotations in daemon mode, 0 rotates every 30 seconds
+        self.server_mode = "threaded"  # Local proxy server: "threaded" or "asyncio"
+        self.max_connections = 1024  # Client connections served at once in asyncio mode
+        self.source_cache_ttl = 600.0  # Seconds a scraped source is reused without asking again
+        self.proxy_source_specs: List[Dict] = list(DEFAULT_PROXY_SOURCES)
+        self.health_checks_per_second = 20.0  # Budget of the background health checker
+        self.health_min_interval = 60.0  # Seconds between checks of a flaky proxy
+        self.health_max_interval = 3600.0  # Seconds between checks of a fast, reliable proxy
+        self.health_evict_after = 5  # Failed checks in a row before a proxy is dropped
+        self.health_checker: Optional[HealthChecker] = None
+        self.environment = EnvironmentCache(self.cache_dir / "env.json")
+        self.store = ProxyStore(self.db_file)
         self.load_config()
-        self.ensure_tor_running()
+        self.upstream_sessions = UpstreamSessionPool(self.upstream_pool_size, self.upstream_idle_timeout)
+        self.upstream_switch = UpstreamSwitch(
+            self.upstream_sessions,
+            self.upstream_drain_timeout,
+            policy=self.balance_policy,
+            sticky=self.sticky_hosts,
+            connect_timeout=self.upstream_connect_timeout
+        )
+        self.switch_proxy(self.current_proxy)
+
+    @property
+    def proxy_list(self) -> List[ProxyRecord]:
+        return list(self.proxy_pool)
+
+    @proxy_list.setter
+    def proxy_list(self, proxies: List[ProxyRecord]) -> None:
+        self.proxy_pool.replace(proxies)
+
+    @property
+    def os_type(self) -> str:
+        return self.environment.get("os_type", self.detect_os)
 
     def detect_os(self) -> str:
         try:
             if platform.system() == "Linux":
+                import distro
                 distro_id = distro.id().lower()
                 if distro_id in ["ubuntu", "debian", "kali"]:
                     return "debian"
@@ -195,10 +2899,8 @@ class ProxyAnonymizer:
 
     def install_dependencies(self) -> None:
         """Install required dependencies"""
-        try:
-            import requests
-            import bs4
-        except ImportError:
+        # Look the packages up without paying for importing them
+        if not all(importlib.util.find_spec(name) for name in ("requests", "bs4")):
             if self.os_type == "arch":
                 subprocess.check_call('sudo pacman -Sy --noconfirm python-requests python-beautifulsoup4', shell=True)
             elif self.os_type == "debian":
@@ -211,9 +2913,7 @@ class ProxyAnonymizer:
 
     def install_tor(self) -> None:
         """Install and configure Tor"""
-        try:
-            subprocess.check_output('which tor', shell=True)
-        except subprocess.CalledProcessError:
+        if not shutil.which('tor'):
             if self.os_type == "arch":
                 subprocess.check_call('sudo pacman -Sy --noconfirm tor', shell=True)
             elif self.os_type == "debian":
@@ -227,60 +2927,142 @@ class ProxyAnonymizer:
 
     def start_tor_service(self) -> None:
         if self.os_type in ["arch", "debian", "rhel"]:
-            subprocess.check_call('sudo systemctl start tor', shell=True)
-            time.sleep(2)
+            try:
+                subprocess.check_call(['sudo', 'systemctl', 'start', 'tor'])
+                time.sleep(2)
+            except (OSError, subprocess.CalledProcessError) as e:
+                logging.error(f"Failed to start Tor: {e}")
 
     def ensure_tor_running(self) -> None:
         """Ensure Tor service is running"""
-        try:
-            # Check if Tor is running
-            subprocess.check_output('systemctl is-active tor', shell=True)
-        except subprocess.CalledProcessError:
+        # A listening SOCKS port is all we need, and much cheaper to check than asking systemd
+        if not self.tcp_probe(ProxyRecord('socks5', '127.0.0.1', self.tor_port), timeout=1):
             self.start_tor_service()
 
-    def get_tor_ip(self) -> str:
+    def get_tor_ip(self, circuit: Optional[TorCircuit] = None) -> str:
         """Get current IP through Tor network"""
+        url = circuit.url if circuit else f'socks5h://127.0.0.1:{self.tor_port}'
         try:
             proxies = {
-                'http': f'socks5://127.0.0.1:{self.tor_port}',
-                'https': f'socks5://127.0.0.1:{self.tor_port}'
+                'http': url,
+                'https': url
             }
-            response = requests.get(self.verify_url, proxies=proxies, timeout=10)
+            started = time.monotonic()
+            response = self.upstream_sessions.session_for(proxies).get(self.verify_url, timeout=10)
+            if circuit:
+                circuit.record(True, time.monotonic() - started)
             return response.text.strip()
         except requests.RequestException as e:
+            if circuit:
+                circuit.record(False)
             logging.error(f"Failed to get Tor IP: {e}")
             return "Unknown"
 
-    def new_tor_circuit(self) -> None:
-        """Request new Tor circuit"""
+    def start_tor_pool(self) -> None:
+        """Set up the Tor circuits rotation balances over, launching our own instances if configured"""
+        self.ensure_tor_running()
+        self.tor_pool = TorPool(
+            self.cache_dir / "tor",
+            socks_port=self.tor_port,
+            control_port=self.tor_control_port,
+            password=self.tor_control_password,
+            instances=self.tor_instances,
+            lanes=self.tor_lanes,
+            base_port=self.tor_base_port
+        )
+        self.tor_pool.start()
+
+    def stop_tor_pool(self) -> None:
+        """Close Tor control connections and stop our own Tor instances"""
+        if self.tor_pool:
+            self.tor_pool.stop()
+            self.tor_pool = None
+
+    def new_tor_circuit(self) -> Optional[TorCircuit]:
+        """Pick a Tor circuit and move it to a fresh one"""
+        if self.tor_pool is None:
+            self.start_tor_pool()
+        circuit = self.tor_pool.select()
         try:
-            # Send signal to Tor to get new circuit
-            subprocess.check_call(f'echo -e "AUTHENTICATE\r\nSIGNAL NEWNYM\r\nQUIT" | nc localhost {self.tor_control_port}', shell=True)
-            time.sleep(2)  # Wait for new circuit to be established
-            logging.info("New Tor circuit established")
-        except subprocess.CalledProcessError as e:
+            if circuit.renew():
+                logging.info(f"New Tor circuit established on {circuit}")
+            else:
+                logging.info("Tor rate limits new identities, keeping the current circuit")
+        except OSError as e:
             logging.error(f"Failed to get new Tor circuit: {e}")
-            # Try alternative method using systemctl
+        return circuit
+
+    def select_proxy(self) -> Optional[ProxyRecord]:
+        """Best scoring candidate out of the external proxies and the Tor circuits"""
+        candidates = [self.proxy_pool.select()]
+        if self.tor_pool:
+            candidates.append(self.tor_pool.select())
+        return min(filter(None, candidates), key=ProxyRecord.score, default=None)
+
+    def prepare_upstream(self, attempts: int = 3) -> Tuple[Optional[ProxyRecord], str]:
+        """Find a working upstream and warm its connections, falling back to a fresh Tor circuit"""
+        started = time.monotonic()
+        try:
+            return self.find_upstream(attempts)
+        finally:
+            METRICS.observe('proxy_anonymizer_rotation_prepare_seconds', time.monotonic() - started)
+
+    def find_upstream(self, attempts: int) -> Tuple[Optional[ProxyRecord], str]:
+        for _ in range(attempts):
+            # Try the best of a few random proxies and Tor circuits first
+            proxy = self.select_proxy()
+            if proxy is None:
+                break
+            if isinstance(proxy, TorCircuit):
+                proxy.renew()
+            proxies = {'http': proxy.url, 'https': proxy.url}
             try:
-                subprocess.check_call('sudo systemctl restart tor', shell=True)
-                time.sleep(2)
-                logging.info("Tor service restarted for new circuit")
-            except subprocess.CalledProcessError:
-                logging.error("Failed to restart Tor service")
+                # Verified through the shared session, so the local server reuses the open connection
+                started = time.monotonic()
+                response = self.upstream_sessions.session_for(proxies).get(self.verify_url, timeout=10)
+                self.proxy_pool.record(proxy, True, time.monotonic() - started)
+                return proxy, response.text.strip()
+            except requests.RequestException:
+                self.proxy_pool.record(proxy, False)
+                if proxy.url != self.upstream_switch.current.url:
+                    self.upstream_sessions.close(proxy.url)
+        # If no proxy works, use a fresh Tor circuit
+        with self.rotation_lock:
+            if not self.rotating:
+                return None, "Unknown"
+            circuit = self.new_tor_circuit()
+        return circuit, self.get_tor_ip(circuit)
+
+    def sync_store(self) -> None:
+        """Write pool changes and the current proxy to the database"""
+        # Tor circuits are set up again on every start, only remember external proxies
+        current = None if isinstance(self.current_proxy, TorCircuit) else self.current_proxy
+        self.store.sync(self.proxy_pool, current)
 
-    def verify_proxy(self, proxy: Dict[str, str]) -> bool:
-        """Verify if a proxy is working"""
+    def tcp_probe(self, proxy: ProxyRecord, timeout: float = 3) -> bool:
+        """Check that the proxy port accepts TCP connections"""
+        try:
+            with socket.create_connection((proxy.host, proxy.port), timeout=timeout):
+                return True
+        except (OSError, ValueError):
+            return False
+
+    def verify_proxy(self, proxy: ProxyRecord) -> bool:
+        """Verify if a proxy is working, recording the result is up to the caller"""
+        # Don't spend three HTTP attempts on a host that isn't even listening
+        if not self.tcp_probe(proxy):
+            return False
         try:
             proxies = {
-                "http": f"{proxy['type']}://{proxy['host']}:{proxy['port']}",
-                "https": f"{proxy['type']}://{proxy['host']}:{proxy['port']}"
+                "http": proxy.url,
+                "https": proxy.url
             }
             # Try multiple times with different timeouts
             for _ in range(3):
                 try:
                     response = requests.get(
-                        self.verify_url, 
-                        proxies=proxies, 
+                        self.verify_url,
+                        proxies=proxies,
                         timeout=10
                     )
                     if response.status_code == 200:
@@ -293,20 +3075,24 @@ class ProxyAnonymizer:
 
     def add_proxy(self, proxy_type: str, host: str, port: str) -> None:
         """Add a new proxy to the list"""
-        proxy = {
-            "type": proxy_type,
-            "host": host,
-            "port": port
-        }
+        try:
+            proxy = ProxyRecord(proxy_type, host, port)
+        except ValueError:
+            logging.error(f"Invalid proxy port: {host}:{port}")
+            return
+        if proxy in self.proxy_pool:
+            logging.info(f"Proxy already listed: {host}:{port}")
+            return
         if self.verify_proxy(proxy):
-            self.proxy_list.append(proxy)
+            self.proxy_pool.add(proxy)
+            self.record_check(proxy, True)
             self.save_config()
             logging.info(f"Added new proxy: {host}:{port}")
         else:
             logging.error(f"Failed to verify proxy: {host}:{port}")
 
     def change_proxy(self) -> None:
-        """Change to a random proxy from the list"""
+        """Change to the best of a few random proxies from the list"""
         clear_screen()
         self.print_banner()
         
@@ -314,39 +3100,119 @@ class ProxyAnonymizer:
             print("\033[1;31mNo proxies available. Please update the proxy list first.\033[0m")
             return
 
-        self.current_proxy = random.choice(self.proxy_list)
-        proxies = {
-            "http": f"{self.current_proxy['type']}://{self.current_proxy['host']}:{self.current_proxy['port']}",
-            "https": f"{self.current_proxy['type']}://{self.current_proxy['host']}:{self.current_proxy['port']}"
-        }
+        self.switch_proxy(self.proxy_pool.select())
+        proxies = self.get_current_proxies()
         
         try:
+            started = time.monotonic()
             response = requests.get(self.verify_url, proxies=proxies, timeout=10)
+            self.proxy_pool.record(self.current_proxy, True, time.monotonic() - started)
             new_ip = response.text.strip()
             print(f"\n\033[1;32mSuccessfully changed IP to: {new_ip}\033[0m")
-            print(f"Using proxy: {self.current_proxy['type']}://{self.current_proxy['host']}:{self.current_proxy['port']}")
+            print(f"Using proxy: {self.current_proxy}")
         except requests.RequestException as e:
+            self.proxy_pool.record(self.current_proxy, False)
             print(f"\n\033[1;31mFailed to change proxy: {e}\033[0m")
 
+    def record_check(self, proxy: ProxyRecord, ok: bool, latency: Optional[float] = None) -> None:
+        """Score a verification result and keep it in the check history"""
+        self.proxy_pool.record(proxy, ok, latency)
+        self.store.log_check(proxy, ok, latency)
+
     def save_config(self) -> None:
-        """Save proxy configuration to file"""
+        """Save settings to the config file and proxy changes to the database"""
+        # Command line overrides, one-off menu choices and defaults stay out of the file
         config = {
-            "proxy_list": self.proxy_list,
-            "current_proxy": self.current_proxy
+            "settings": self.file_settings,
+            "proxy_sources": self.proxy_source_specs
         }
         with open(self.config_file, 'w') as f:
             json.dump(config, f, indent=4)
+        self.sync_store()
 
     def load_config(self) -> None:
-        """Load proxy configuration from file"""
+        """Load settings from the config file and proxies from the database"""
+        self.load_settings()
+        proxies, current_proxy = self.store.load()
+        self.proxy_pool.load(proxies)
+        # Share health updates with the pooled record when the proxy is still listed
+        self.current_proxy = current_proxy and (self.proxy_pool.get(current_proxy) or current_proxy)
+
+    def load_settings(self) -> None:
+        """Read settings and proxy sources from the config file, then apply the overrides"""
         if self.config_file.exists():
             try:
                 with open(self.config_file, 'r') as f:
                     config = json.load(f)
-                    self.proxy_list = config.get("proxy_list", [])
-                    self.current_proxy = config.get("current_proxy")
-            except json.JSONDecodeError:
+                    self.proxy_source_specs = config.get("proxy_sources", self.proxy_source_specs)
+                    self.file_settings = dict(config.get("settings", {}))
+                    for name, value in self.file_settings.items():
+                        if name not in self.SETTINGS:
+                            continue
+                        try:
+                            setattr(self, name, self.parse_setting(self.SETTINGS[name], value))
+                        except (TypeError, ValueError):
+                            logging.warning(f"Ignoring setting {name}: {value!r} is not a valid {self.SETTINGS[name].__name__}")
+                if "proxy_list" in config:
+                    self.migrate_config(config)
+            except (json.JSONDecodeError, TypeError, ValueError):
                 logging.error("Failed to load configuration file")
+        for name, value in self.overrides.items():
+            setattr(self, name, value)
+        if self.balance_policy not in UpstreamSwitch.POLICIES:
+            logging.warning(f"Unknown balance_policy {self.balance_policy!r}, using least_connections")
+            self.balance_policy = "least_connections"
+
+    @staticmethod
+    def parse_setting(kind: type, value):
+        """Check a config file value against the setting's type, floats and bools are never truncated or guessed"""
+        if kind is bool:
+            if isinstance(value, str) and value.lower() in ('true', 'false'):
+                return value.lower() == 'true'
+            if isinstance(value, bool):
+                return value
+        elif kind is int:
+            if isinstance(value, float) and value.is_integer():
+                return int(value)
+            if isinstance(value, (int, str)) and not isinstance(value, bool):
+                return int(value)
+        elif kind is float:
+            if isinstance(value, (int, float, str)) and not isinstance(value, bool):
+                return float(value)
+        elif isinstance(value, kind):
+            return value
+        raise TypeError(f"expected {kind.__name__}")
+
+    def reload_config(self) -> None:
+        """Re-read the config file and apply what can change without a restart"""
+        self.load_settings()
+        with self.upstream_switch.lock:
+            self.upstream_switch.grace = self.upstream_drain_timeout
+            self.upstream_switch.policy = self.balance_policy
+            self.upstream_switch.sticky = self.sticky_hosts
+            self.upstream_switch.connect_timeout = self.upstream_connect_timeout
+        if self.health_checker:
+            self.stop_health_checker()
+            self.start_health_checker()
+        # The local port, server mode and Tor instances stay as they were started
+        logging.info(f"Reloaded {self.config_file}")
+
+    def migrate_config(self, config: Dict) -> None:
+        """Move the proxy list of an old JSON config into the database, once"""
+        if self.store.is_empty():
+            pool = ProxyPool()
+            for entry in config.get("proxy_list") or []:
+                try:
+                    pool.add(ProxyRecord.from_dict(entry))
+                except (KeyError, TypeError, ValueError):
+                    continue
+            current = config.get("current_proxy")
+            self.store.sync(pool, ProxyRecord.from_dict(current) if current else None)
+            logging.info(f"Migrated {len(pool)} proxies from {self.config_file} to {self.db_file}")
+        for key in ("proxy_list", "current_proxy"):
+            config.pop(key, None)
+        with open(self.config_file, 'w') as f:
+            json.dump(config, f, indent=4)
 
     def print_banner(self) -> None:
         """Print program banner"""
@@ -364,14 +3230,6 @@ class ProxyAnonymizer:
         """
         print(banner)
 
-    def check_nc_installed(self) -> bool:
-        """Check if netcat (nc) is installed"""
-        try:
-            subprocess.check_output('which nc', shell=True)
-            return True
-        except subprocess.CalledProcessError:
-            return False
-
     def cleanup_proxy_list(self) -> None:
         """Clean up the proxy list by removing non-working proxies"""
         clear_screen()
@@ -390,12 +3248,22 @@ class ProxyAnonymizer:
         print(f"\nVerifying {original_count} proxies...")
         print("Press Ctrl+C to stop and return to menu")
         
+        checked = 0
+
+        def on_result(proxy: ProxyRecord, latency: Optional[float]) -> None:
+            nonlocal checked
+            checked += 1
+            self.record_check(proxy, latency is not None, latency)
+            if latency is not None:
+                working_proxies.append(proxy)
+            print(f"\rChecking proxy {checked}/{original_count}", end="")
+
         try:
-            for i, proxy in enumerate(self.proxy_list, 1):
-                print(f"\rChecking proxy {i}/{original_count}", end="")
-                if self.verify_proxy(proxy):
-                    working_proxies.append(proxy)
+            self.make_verifier().run(self.proxy_list, on_result=on_result)
             print()
+            # Keep the original ordering of the list
+            working = set(working_proxies)
+            working_proxies = [proxy for proxy in self.proxy_list if proxy in working]
             
             removed_count = original_count - len(working_proxies)
             self.proxy_list = working_proxies
@@ -433,45 +3301,34 @@ class ProxyAnonymizer:
         
         for i, proxy in enumerate(self.proxy_list, 1):
             status = "\033[1;32m✓\033[0m" if proxy == self.current_proxy else " "
-            print(f"{status} {i}. {proxy['type']}://{proxy['host']}:{proxy['port']}")
+            health = f" ({proxy.latency * 1000:.0f} ms, {proxy.success_rate:.0%} ok)" if proxy.latency is not None else ""
+            print(f"{status} {i}. {proxy}{health}")
+
+    def proxy_sources(self) -> List["ProxySource"]:
+        """Build the configured proxy sources, skipping invalid entries"""
+        sources = []
+        for spec in self.proxy_source_specs:
+            try:
+                sources.append(make_proxy_source(spec))
+            except (KeyError, TypeError, ValueError) as e:
+                logging.error(f"Invalid proxy source {spec}: {e}")
+        return sources
 
-    def fetch_proxies(self) -> List[Dict[str, str]]:
+    def fetch_proxies(self) -> List[ProxyRecord]:
         """Fetch proxies from various sources"""
         proxies = []
-        sources = [
-            "https://proxy-list.net/",
-            "https://www.sslproxies.org/",
-            "https://www.us-proxy.org/"
-        ]
-
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
+        sources = self.proxy_sources()
+        if not sources:
+            return proxies
+        cache = SourceCache(self.cache_dir / "sources", self.source_cache_ttl)
 
-        for source in sources:
-            try:
-                response = requests.get(source, headers=headers, timeout=10)
-                soup = BeautifulSoup(response.text, 'html.parser')
-                table = soup.find('table')
-                
-                if table:
-                    for row in table.find_all('tr')[1:]:  # Skip header row
-                        cols = row.find_all('td')
-                        if len(cols) >= 2:
-                            ip = cols[0].text.strip()
-                            port = cols[1].text.strip()
-                            proxy_type = 'https' if 'sslproxies' in source else 'http'
-                            
-                            proxy = {
-                                'type': proxy_type,
-                                'host': ip,
-                                'port': port
-                            }
-                            proxies.append(proxy)
-            except Exception as e:
-                logging.error(f"Failed to fetch proxies from {source}: {e}")
+        # All sources are fetched at once, so this takes as long as the slowest one
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(sources)) as executor:
+            for source_proxies in executor.map(lambda source: source.fetch(cache), sources):
+                proxies.extend(source_proxies)
 
-        return proxies
+        # Sources overlap a lot, don't verify the same proxy twice
+        return dedupe_proxies(proxies)
 
     def update_proxies(self) -> None:
         """Update the proxy list with fresh proxies"""
@@ -495,7 +3352,7 @@ class ProxyAnonymizer:
                     print("\033[1;31mPlease enter a valid number.\033[0m")
             
             logging.info("Fetching proxies...")
-            new_proxies = self.fetch_proxies()
+            new_proxies = [proxy for proxy in self.fetch_proxies() if proxy not in self.proxy_pool]
             print(f"\nFound {len(new_proxies)} potential proxies")
             
             print(f"\nVerifying proxies until finding {desired_quantity} working ones (this may take a few minutes)...")
@@ -504,13 +3361,10 @@ class ProxyAnonymizer:
             working_proxies = self.verify_proxies_concurrently(new_proxies, desired_quantity)
             
             # Add only new working proxies to the list
-            existing_proxies = {(p['host'], p['port']) for p in self.proxy_list}
-            for proxy in working_proxies:
-                if (proxy['host'], proxy['port']) not in existing_proxies:
-                    self.proxy_list.append(proxy)
+            added = self.proxy_pool.merge(working_proxies)
             
             self.save_config()
-            print(f"\n\033[1;32mAdded {len(working_proxies)} new working proxies\033[0m")
+            print(f"\n\033[1;32mAdded {added} new working proxies\033[0m")
             print("\nPress Enter to return to menu...")
             input()
             
@@ -519,39 +3373,49 @@ class ProxyAnonymizer:
             time.sleep(1)
             return
 
-    def verify_proxies_concurrently(self, proxies: List[Dict[str, str]], desired_quantity: int = 100, max_workers: int = 20) -> List[Dict[str, str]]:
+    def make_verifier(self, concurrency: Optional[int] = None) -> AsyncProxyVerifier:
+        """Build an async verifier from the current settings"""
+        return AsyncProxyVerifier(
+            self.verify_url,
+            concurrency=concurrency or self.verify_concurrency,
+            timeout=self.verify_timeout,
+            fallback=self.verify_proxy
+        )
+
+    def verify_proxies_concurrently(self, proxies: List[ProxyRecord], desired_quantity: int = 100, max_workers: Optional[int] = None) -> List[ProxyRecord]:
         """Verify multiple proxies concurrently"""
         working_proxies = []
         timeout_seconds = 300  # 5 minutes timeout
-        
-        def verify_single_proxy(proxy: Dict[str, str]) -> Optional[Dict[str, str]]:
-            if self.verify_proxy(proxy):
-                return proxy
-            return None
+
+        def on_result(proxy: ProxyRecord, latency: Optional[float]) -> None:
+            self.record_check(proxy, latency is not None, latency)
+            if latency is None:
+                return
+            working_proxies.append(proxy)
+            print(f"\r\033[1;32mWorking proxies found: {len(working_proxies)}/{desired_quantity}\033[0m", end="")
+            if len(working_proxies) >= desired_quantity:
+                print("\n\033[1;32mReached desired number of proxies!\033[0m")
 
         logging.info(f"Verifying proxies until finding {desired_quantity} working ones or checking all available proxies...")
-        
+
+        verifier = self.make_verifier(max_workers)
         try:
-            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-                future_to_proxy = {executor.submit(verify_single_proxy, proxy): proxy for proxy in proxies}
-                
-                try:
-                    for future in concurrent.futures.as_completed(future_to_proxy, timeout=timeout_seconds):
-                        result = future.result()
-                        if result:
-                            working_proxies.append(result)
-                            print(f"\r\033[1;32mWorking proxies found: {len(working_proxies)}/{desired_quantity}\033[0m", end="")
-                            if len(working_proxies) >= desired_quantity:
-                                print("\n\033[1;32mReached desired number of proxies!\033[0m")
-                                break
-                except concurrent.futures.TimeoutError:
-                    print(f"\n\033[1;33mProxy verification timed out after {timeout_seconds} seconds\033[0m")
-                except Exception as e:
-                    print(f"\n\033[1;31mError during proxy verification: {e}\033[0m")
-                
+            verifier.run(
+                proxies,
+                desired_quantity=desired_quantity,
+                on_result=on_result,
+                deadline=timeout_seconds
+            )
+        except asyncio.TimeoutError:
+            print(f"\n\033[1;33mProxy verification timed out after {timeout_seconds} seconds\033[0m")
         except KeyboardInterrupt:
             print("\n\033[1;33mProxy verification interrupted by user\033[0m")
-            return working_proxies
+        except Exception as e:
+            print(f"\n\033[1;31mError during proxy verification: {e}\033[0m")
+
+        if verifier.skipped:
+            print(f"\n\033[1;33mSkipped {verifier.skipped} remaining checks\033[0m")
+            logging.info(f"Stopped verification with {verifier.skipped} of {len(proxies)} checks skipped")
 
         return working_proxies
 
@@ -598,8 +3462,27 @@ user_pref("network.proxy.no_proxies_on", "");
         """Start a local proxy server that forwards requests through the current proxy"""
         def run_server():
             try:
-                handler = lambda *args, **kwargs: ProxyHandler(*args, proxies=self.get_current_proxies(), **kwargs)
+                if self.server_mode == "asyncio":
+                    self.local_proxy_server = AsyncProxyServer(
+                        port,
+                        self.upstream_switch,
+                        max_connections=self.max_connections
+                    )
+                    self.local_proxy_server.serve_forever()
+                    return
+                handler = lambda *args, **kwargs: ProxyHandler(
+                    *args,
+                    upstreams=self.upstream_switch,
+                    sessions=self.upstream_sessions,
+                    **kwargs
+                )
                 self.local_proxy_server = ThreadedHTTPServer(('127.0.0.1', port), handler)
+                # Firefox is pointed at the same port for SOCKS, see configure_firefox_proxy
+                self.local_proxy_server.socks_handler = lambda *args, **kwargs: SocksHandler(
+                    *args,
+                    upstreams=self.upstream_switch,
+                    **kwargs
+                )
                 self.local_proxy_server.serve_forever()
             except Exception as e:
                 logging.error(f"Local proxy server error: {e}")
@@ -608,7 +3491,34 @@ user_pref("network.proxy.no_proxies_on", "");
         server_thread = threading.Thread(target=run_server)
         server_thread.daemon = True
         server_thread.start()
-        logging.info(f"Local proxy server started on port {port}")
+        logging.info(f"Local proxy server started on port {port} ({self.server_mode} mode)")
+
+    def start_health_checker(self) -> None:
+        """Start re-verifying the proxy pool in the background"""
+        self.health_checker = HealthChecker(
+            self.proxy_pool,
+            self.make_verifier,
+            on_result=self.record_check,
+            checks_per_second=self.health_checks_per_second,
+            min_interval=self.health_min_interval,
+            max_interval=self.health_max_interval,
+            evict_after=self.health_evict_after
+        )
+        self.health_checker.start()
+        logging.info("Background health checker started")
+
+    def stop_health_checker(self) -> None:
+        """Stop the background health checker"""
+        if self.health_checker:
+            self.health_checker.stop()
+            self.health_checker = None
+            logging.info("Background health checker stopped")
+
+    def traffic_recorder(self, proxy: Optional[ProxyRecord]) -> Optional[Callable[[bool, Optional[float]], None]]:
+        """Return a callback that scores a proxy from live traffic"""
+        if not proxy:
+            return None
+        return lambda ok, latency: self.proxy_pool.record(proxy, ok, latency)
 
     def stop_local_proxy_server(self) -> None:
         """Stop the local proxy server"""
@@ -617,17 +3527,53 @@ user_pref("network.proxy.no_proxies_on", "");
             self.local_proxy_server.server_close()
             logging.info("Local proxy server stopped")
 
+    def switch_proxy(self, proxy: Optional[ProxyRecord]) -> None:
+        """Make `proxy` the current upstream (None means Tor), connections on the old one drain in the background"""
+        self.current_proxy = proxy
+        upstreams = [self.make_upstream(proxy, self.get_current_proxies())]
+        if self.balance_proxies > 1:
+            # The rest of the best healthy proxies share the load with the verified one
+            for other in self.proxy_pool.best(self.balance_proxies):
+                if len(upstreams) >= self.balance_proxies:
+                    break
+                if other != proxy:
+                    upstreams.append(self.make_upstream(other, {'http': other.url, 'https': other.url}))
+        if self.tor_pool and (self.balance_proxies > 1 or proxy is None or isinstance(proxy, TorCircuit)):
+            # Every Tor lane and instance is an upstream of its own so they carry traffic side by
+            # side, on top of the `balance_proxies` external ones
+            for circuit in self.tor_pool.circuits:
+                if circuit != proxy:
+                    upstreams.append(self.make_upstream(circuit, {'http': circuit.url, 'https': circuit.url}))
+        fallback = None
+        if proxy is not None and not isinstance(proxy, TorCircuit):
+            # Tor carries the traffic while every proxy's breaker is open
+            tor = f'socks5h://127.0.0.1:{self.tor_port}'
+            fallback = Upstream(None, {'http': tor, 'https': tor},
+                                breaker=CircuitBreaker(self.breaker_failures, self.breaker_cooldown))
+        self.upstream_switch.swap_all(upstreams, fallback)
+
+    def make_upstream(self, proxy: Optional[ProxyRecord], proxies: Dict[str, str]) -> Upstream:
+        """Hand a proxy to the local server, scored by its traffic and guarded by a circuit breaker"""
+        breaker = CircuitBreaker(self.breaker_failures, self.breaker_cooldown, lambda: self.upstream_tripped(proxy))
+        return Upstream(proxy, proxies, self.traffic_recorder(proxy), breaker)
+
+    def upstream_tripped(self, proxy: Optional[ProxyRecord]) -> None:
+        """Rotate early when the current upstream keeps failing, instead of waiting for the next rotation"""
+        if proxy is self.current_proxy and self.rotating:
+            logging.warning(f"Current upstream {proxy or 'Tor'} is failing, rotating early")
+            self.rotate_now.set()
+
     def get_current_proxies(self) -> Dict[str, str]:
         """Get the current proxy configuration"""
         if self.current_proxy:
             return {
-                "http": f"{self.current_proxy['type']}://{self.current_proxy['host']}:{self.current_proxy['port']}",
-                "https": f"{self.current_proxy['type']}://{self.current_proxy['host']}:{self.current_proxy['port']}"
+                "http": self.current_proxy.url,
+                "https": self.current_proxy.url
             }
         else:
             return {
-                'http': f'socks5://127.0.0.1:{self.tor_port}',
-                'https': f'socks5://127.0.0.1:{self.tor_port}'
+                'http': f'socks5h://127.0.0.1:{self.tor_port}',
+                'https': f'socks5h://127.0.0.1:{self.tor_port}'
             }
 
     def start_proxy_rotation(self) -> None:
@@ -661,9 +3607,9 @@ user_pref("network.proxy.no_proxies_on", "");
             # Get local proxy port
             while True:
                 try:
-                    local_port = input("\nEnter local proxy port (default: 5005): ").strip()
+                    local_port = input(f"\nEnter local proxy port (default: {self.local_port}): ").strip()
                     if not local_port:
-                        local_port = 5005
+                        local_port = self.local_port
                     else:
                         local_port = int(local_port)
                     if 1024 <= local_port <= 65535:
@@ -672,13 +3618,25 @@ user_pref("network.proxy.no_proxies_on", "");
                 except ValueError:
                     print("\033[1;31mPlease enter a valid port number.\033[0m")
 
+            # Get local proxy server mode
+            while True:
+                default_mode = "2" if self.server_mode == "asyncio" else "1"
+                mode = input(f"\nEnter server mode, 1 for threaded or 2 for event loop (default: {default_mode}): ").strip() or default_mode
+                if mode in ("1", "2"):
+                    self.server_mode = "asyncio" if mode == "2" else "threaded"
+                    break
+                print("\033[1;31mPlease enter 1 or 2.\033[0m")
+
             print("\n\033[1;36mProxy Rotation Settings:\033[0m")
             print(f"Rotation delay: {'Infinite (30s minimum)' if delay == 0 else f'{delay} seconds'}")
             print(f"Local proxy port: {local_port}")
+            print(f"Server mode: {'Event loop' if self.server_mode == 'asyncio' else 'Threaded'}")
 
             # Start local proxy server
             print("\n\033[1;33mStarting local proxy server...\033[0m")
-            self.start_local_proxy_server(local_port)
+            if self.tor_instances:
+                print(f"\033[1;33mStarting {self.tor_instances} Tor instances...\033[0m")
+            self.start_rotation_services(local_port)
             time.sleep(2)  # Wait for server to start
 
             # Configure and start Firefox
@@ -699,113 +3657,228 @@ user_pref("network.proxy.no_proxies_on", "");
 
             print("\n\033[1;32mStarting proxy rotation...\033[0m")
             print("Press Ctrl+C to stop")
-            
-            rotation_running = True
-            while rotation_running:
-                try:
-                    # Try to use a random proxy first
-                    self.current_proxy = random.choice(self.proxy_list)
-                    proxies = self.get_current_proxies()
-                    
-                    try:
-                        # Try to get IP through proxy
-                        response = requests.get(self.verify_url, proxies=proxies, timeout=10)
-                        new_ip = response.text.strip()
-                        proxy_type = "External Proxy"
-                    except requests.RequestException:
-                        # If proxy fails, use Tor
-                        self.new_tor_circuit()
-                        new_ip = self.get_tor_ip()
-                        proxy_type = "Tor Network"
-                        proxies = {
-                            'http': f'socks5://127.0.0.1:{self.tor_port}',
-                            'https': f'socks5://127.0.0.1:{self.tor_port}'
-                        }
-                    
-                    # Display current status
-                    clear_screen()
-                    self.print_banner()
-                    print("\n\033[1;36mCurrent Proxy Status:\033[0m")
-                    print(f"IP Address: {new_ip}")
-                    print(f"Connection Type: {proxy_type}")
-                    if proxy_type == "External Proxy":
-                        print(f"Proxy: {self.current_proxy['type']}://{self.current_proxy['host']}:{self.current_proxy['port']}")
-                    else:
-                        print(f"Tor SOCKS Port: {self.tor_port}")
-                    if delay > 0:
-                        print(f"Next rotation in: {delay} seconds")
-                    else:
-                        print("Rotation mode: Infinite (30s minimum)")
-                    print("\n\033[1;33mPress Ctrl+C to stop\033[0m")
-                    
-                    if delay > 0:
-                        # Wait for next rotation with countdown
-                        for i in range(delay, 0, -1):
-                            print(f"\rTime until next rotation: {i} seconds", end="")
-                            time.sleep(1)
-                        print()
-                    else:
-                        # Infinite rotation with minimum 30-second delay
-                        for i in range(30, 0, -1):
-                            print(f"\rTime until next rotation: {i} seconds", end="")
-                            time.sleep(1)
-                        print()
-                    
-                except KeyboardInterrupt:
-                    print("\n\n\033[1;33mProxy rotation stopped by user\033[0m")
-                    rotation_running = False
-                except Exception as e:
-                    print(f"\n\033[1;31mError during proxy rotation: {e}\033[0m")
-                    print("Waiting 30 seconds before retrying...")
-                    for i in range(30, 0, -1):
-                        print(f"\rRetrying in: {i} seconds", end="")
-                        time.sleep(1)
-                    print()
-            
+
+            try:
+                self.rotate(
+                    delay,
+                    on_rotate=lambda new_ip: self.print_rotation_status(new_ip, delay),
+                    on_error=self.print_rotation_error,
+                    wait=lambda seconds, label: countdown(seconds, label, self.rotate_now)
+                )
+            except KeyboardInterrupt:
+                print("\n\n\033[1;33mProxy rotation stopped by user\033[0m")
+
             # Stop the local proxy server when rotation ends
-            self.stop_local_proxy_server()
+            self.stop_rotation_services()
+            self.save_config()
                     
         except KeyboardInterrupt:
             print("\n\n\033[1;33mProxy rotation setup cancelled\033[0m")
-            self.stop_local_proxy_server()
+            self.stop_rotation_services()
             time.sleep(1)
             return
 
-    def install_netcat(self) -> None:
-        """Install netcat if not already installed"""
+    def print_rotation_status(self, new_ip: str, delay: int) -> None:
+        """Show the upstream rotation just switched to"""
+        clear_screen()
+        self.print_banner()
+        print("\n\033[1;36mCurrent Proxy Status:\033[0m")
+        print(f"IP Address: {new_ip}")
+        if isinstance(self.current_proxy, TorCircuit):
+            print("Connection Type: Tor Network")
+            print(f"Tor circuit: {self.current_proxy}")
+        else:
+            print("Connection Type: External Proxy")
+            print(f"Proxy: {self.current_proxy}")
+        if self.health_checker:
+            print(f"Health checks: {self.health_checker.checks} run, {self.health_checker.evicted} dead proxies evicted")
+        if len(self.upstream_switch.upstreams) > 1:
+            print(f"Balancing over: {len(self.upstream_switch.upstreams)} proxies ({self.balance_policy.replace('_', ' ')})")
+        if delay > 0:
+            print(f"Next rotation in: {delay} seconds")
+        else:
+            print("Rotation mode: Infinite (30s minimum)")
+        print("\n\033[1;33mPress Ctrl+C to stop\033[0m")
+
+    def print_rotation_error(self, error: Exception) -> None:
+        print(f"\n\033[1;31mError during proxy rotation: {error}\033[0m")
+        print("Waiting 30 seconds before retrying...")
+
+    def start_rotation_services(self, port: int) -> None:
+        """Start the local proxy server, the health checker and the Tor circuits rotation uses"""
+        self.rotating = True
+        self.start_local_proxy_server(port)
+        self.start_health_checker()
+        self.start_tor_pool()
+
+    def stop_rotation_services(self) -> None:
+        with self.rotation_lock:
+            self.rotating = False
+        self.stop_health_checker()
+        self.stop_tor_pool()
+        self.stop_local_proxy_server()
+
+    def rotate(self, delay: int, on_rotate: Callable[[str], None], on_error: Callable[[Exception], None],
+               wait: Callable[[int, str], None], stop: Optional[threading.Event] = None) -> None:
+        """Switch to a new upstream every `delay` seconds, at least 30, until `stop` is set
+
+        `on_rotate` gets the new exit IP after every switch and `wait` sleeps
+        between rotations, it is given the seconds and a label to show. It
+        should return early once `rotate_now` is set.
+        """
+        # The next upstream is verified and warmed while the current one is in use,
+        # so a rotation only swaps it in and never stalls the local server
+        preparer = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        finished = threading.Event()
+
+        def prepare_later(seconds: float) -> Tuple[Optional[ProxyRecord], str]:
+            # Starts `prepare_lead` seconds before the rotation rather than right after the last one,
+            # a proxy checked a whole delay ahead may be dead and its warm session evicted by then
+            deadline = time.monotonic() + seconds
+            while not self.rotate_now.is_set() and time.monotonic() < deadline:
+                if finished.wait(min(1, deadline - time.monotonic())):
+                    return None, "Unknown"  # Rotation stopped, nobody waits for this one
+            return self.prepare_upstream()
+
+        upcoming = preparer.submit(self.prepare_upstream)
         try:
-            if self.os_type == "arch":
-                subprocess.check_call('sudo pacman -Sy --noconfirm gnu-netcat', shell=True)
-            elif self.os_type == "debian":
-                subprocess.check_call('sudo apt update && sudo apt install -y netcat', shell=True)
-            elif self.os_type == "rhel":
-                subprocess.check_call('sudo dnf install -y nmap-ncat', shell=True)
-            else:
-                print("\n\033[1;31mUnsupported OS. Please install netcat manually.\033[0m")
-                print("Arch Linux: sudo pacman -S gnu-netcat")
-                print("Debian/Ubuntu: sudo apt install netcat")
-                print("RHEL/CentOS: sudo dnf install nmap-ncat")
-                print("\nPress Enter to continue...")
-                input()
-                return
-            print("\n\033[1;32mNetcat installed successfully!\033[0m")
-            time.sleep(1)
-        except subprocess.CalledProcessError as e:
-            print(f"\n\033[1;31mFailed to install netcat: {e}\033[0m")
-            print("Please install it manually using your package manager.")
-            print("\nPress Enter to continue...")
-            input()
+            while not (stop and stop.is_set()):
+                try:
+                    # Wait for the prepared upstream, but not past a stop request
+                    while stop and not upcoming.done():
+                        if stop.wait(0.5):
+                            return
+                    proxy, new_ip = upcoming.result()
+                    self.switch_proxy(proxy)
+                    self.rotate_now.clear()
+                    METRICS.add('proxy_anonymizer_rotations_total', 1,
+                                ('tor' if proxy is None or isinstance(proxy, TorCircuit) else 'proxy',))
+                    upcoming = preparer.submit(prepare_later, max(max(delay, 30) - self.prepare_lead, 0))
+
+                    # Persist health gathered since the last rotation, only changed rows are written
+                    self.sync_store()
+                    on_rotate(new_ip)
+                    wait(max(delay, 30), "Time until next rotation")
+                except Exception as e:
+                    METRICS.add('proxy_anonymizer_rotation_errors_total')
+                    logging.error(f"Error during proxy rotation: {e}")
+                    on_error(e)
+                    if upcoming.done() and upcoming.exception():
+                        upcoming = preparer.submit(self.prepare_upstream)
+                    wait(30, "Retrying in")
+        finally:
+            finished.set()
+            preparer.shutdown(wait=False)
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Proxy management and IP rotation")
+    parser.add_argument('--daemon', action='store_true',
+                        help="run the rotation headless, without the menu or screen output")
+    parser.add_argument('--config', type=Path, help="config file (default: ~/.proxy_anonymizer_config.json)")
+    parser.add_argument('--pid-file', type=Path, default=Path.home() / ".cache" / "proxy-anonymizer" / "daemon.pid",
+                        help="PID file locked while the daemon runs")
+    # Each of these overrides the setting of the same name from the config file
+    parser.add_argument('--port', type=int, dest='local_port', help="local proxy port")
+    parser.add_argument('--delay', type=int, dest='rotation_delay', help="seconds between rotations, 0 for 30")
+    parser.add_argument('--server-mode', choices=('threaded', 'asyncio'), help="local proxy server mode")
+    parser.add_argument('--balance', type=int, dest='balance_proxies', help="spread traffic over this many proxies")
+    parser.add_argument('--balance-policy', choices=UpstreamSwitch.POLICIES, help="how to spread traffic")
+    parser.add_argument('--sticky-hosts', action='store_true', default=None, help="keep each site on one proxy")
+    parser.add_argument('--pool-size', type=int, dest='upstream_pool_size', help="keep-alive connections per upstream")
+    parser.add_argument('--verify-concurrency', type=int, help="proxy checks kept in flight")
+    return parser.parse_args(argv)
+
+def setting_overrides(args: argparse.Namespace) -> Dict:
+    """The settings given on the command line"""
+    return {name: value for name, value in vars(args).items()
+            if name in ProxyAnonymizer.SETTINGS and value is not None}
+
+def lock_pid_file(path: Path):
+    """Take an exclusive lock on the PID file and write our PID, the lock ends with the process"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    pid_file = open(path, 'a+')
+    try:
+        fcntl.flock(pid_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        pid_file.seek(0)
+        pid = pid_file.read().strip()
+        pid_file.close()
+        raise RuntimeError(f"Already running with PID {pid or 'unknown'} ({path})")
+    pid_file.seek(0)
+    pid_file.truncate()
+    pid_file.write(f"{os.getpid()}\n")
+    pid_file.flush()
+    return pid_file
+
+def run_daemon(args: argparse.Namespace) -> int:
+    """Rotate headless until SIGTERM or SIGINT, SIGHUP reloads the config file"""
+    try:
+        pid_file = lock_pid_file(args.pid_file)
+    except RuntimeError as e:
+        logging.error(str(e))
+        return 1
+
+    stop = threading.Event()
+    reload = threading.Event()
+    wake = threading.Event()
+
+    def on_stop(signum, frame):
+        stop.set()
+        wake.set()
+
+    def on_reload(signum, frame):
+        reload.set()
+        wake.set()
+
+    signal.signal(signal.SIGTERM, on_stop)
+    signal.signal(signal.SIGINT, on_stop)
+    signal.signal(signal.SIGHUP, on_reload)
+
+    anonymizer = None
+
+    def wait(seconds: int, label: str) -> None:
+        # Signals wake the daemon at once, a tripped breaker within a second
+        deadline = time.monotonic() + seconds
+        while not wake.is_set() and not anonymizer.rotate_now.is_set() and time.monotonic() < deadline:
+            wake.wait(min(1, deadline - time.monotonic()))
+        wake.clear()
+        if reload.is_set():
+            reload.clear()
+            anonymizer.reload_config()
+
+    def on_rotate(new_ip: str) -> None:
+        logging.info(f"Rotated to {anonymizer.current_proxy or 'Tor'}, exit IP {new_ip}")
+
+    try:
+        anonymizer = ProxyAnonymizer(args.config, setting_overrides(args))
+        if not anonymizer.proxy_list:
+            logging.warning("No proxies in the list, rotating over Tor only")
+        anonymizer.start_rotation_services(anonymizer.local_port)
+        logging.info(f"Daemon running with PID {os.getpid()}, proxy on 127.0.0.1:{anonymizer.local_port}")
+        anonymizer.rotate(anonymizer.rotation_delay, on_rotate, lambda e: None, wait, stop=stop)
+    finally:
+        if anonymizer:
+            anonymizer.stop_rotation_services()
+            anonymizer.sync_store()
+            anonymizer.store.close()
+        try:
+            args.pid_file.unlink()
+        except OSError:
+            pass
+        pid_file.close()
+        logging.info("Daemon stopped")
+    return 0
 
 def main():
-    anonymizer = ProxyAnonymizer()
+    args = parse_args()
+    raise_open_files_limit()
+    if args.daemon:
+        sys.exit(run_daemon(args))
+
+    anonymizer = ProxyAnonymizer(args.config, setting_overrides(args))
     anonymizer.install_dependencies()
     anonymizer.install_tor()
     
-    # Check and install netcat if needed
-    if not anonymizer.check_nc_installed():
-        print("\n\033[1;33mNetcat (nc) not found. Installing...\033[0m")
-        anonymizer.install_netcat()
-    
     try:
         while True:
             anonymizer.print_banner()
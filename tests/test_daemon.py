@@ -0,0 +1,67 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+SCRIPT = Path(__file__).resolve().parent.parent / "proxy_anonymizer.py"
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+class DaemonShutdownTest(unittest.TestCase):
+    """SIGTERM must stop the daemon even while clients hold connections open"""
+
+    def run_daemon(self, server_mode: str) -> None:
+        with tempfile.TemporaryDirectory() as home:
+            port = free_port()
+            pid_file = Path(home) / "daemon.pid"
+            daemon = subprocess.Popen(
+                [sys.executable, str(SCRIPT), '--daemon', '--port', str(port),
+                 '--server-mode', server_mode, '--pid-file', str(pid_file)],
+                cwd=home, env=dict(os.environ, HOME=home),
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+            clients = []
+            try:
+                deadline = time.monotonic() + 30
+                while True:
+                    try:
+                        clients.append(socket.create_connection(('127.0.0.1', port), timeout=1))
+                        break
+                    except OSError:
+                        if time.monotonic() > deadline or daemon.poll() is not None:
+                            self.fail("daemon did not start listening")
+                        time.sleep(0.1)
+                # One idle keep-alive client and one stuck halfway through its request line
+                half_open = socket.create_connection(('127.0.0.1', port), timeout=1)
+                half_open.sendall(b'GET http://127.0.0.1/ HT')
+                clients.append(half_open)
+                time.sleep(0.5)
+
+                started = time.monotonic()
+                daemon.send_signal(signal.SIGTERM)
+                self.assertEqual(daemon.wait(timeout=15), 0)
+                self.assertLess(time.monotonic() - started, 10)
+                self.assertFalse(pid_file.exists())
+            finally:
+                for client in clients:
+                    client.close()
+                if daemon.poll() is None:
+                    daemon.kill()
+                    daemon.wait()
+
+    def test_sigterm_with_open_connections_threaded(self):
+        self.run_daemon('threaded')
+
+    def test_sigterm_with_open_connections_asyncio(self):
+        self.run_daemon('asyncio')
+
+if __name__ == '__main__':
+    unittest.main()
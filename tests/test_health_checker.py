@@ -0,0 +1,38 @@
+import socket
+import sys
+import time
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import proxy_anonymizer as pa
+
+class HealthCheckerStopTest(unittest.TestCase):
+    """Stopping the checker cancels the running sweep instead of waiting for it"""
+
+    def test_stop_during_a_hanging_check(self):
+        # Accepts connections and never answers, so the HTTP check waits for its timeout
+        silent = socket.socket()
+        silent.bind(('127.0.0.1', 0))
+        silent.listen(16)
+        self.addCleanup(silent.close)
+
+        pool = pa.ProxyPool()
+        pool.add(pa.ProxyRecord('http', '127.0.0.1', silent.getsockname()[1]))
+        checker = pa.HealthChecker(
+            pool,
+            lambda concurrency: pa.AsyncProxyVerifier('http://checkip.amazonaws.com', concurrency, timeout=30)
+        )
+        checker.start()
+        time.sleep(1)
+
+        thread = checker.thread
+        started = time.monotonic()
+        checker.stop()
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(checker.checks, 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import proxy_anonymizer as pa
+
+class RotationTest(unittest.TestCase):
+    """The next upstream is prepared shortly before the rotation, not right after the last one"""
+
+    def setUp(self):
+        home = tempfile.TemporaryDirectory()
+        self.addCleanup(home.cleanup)
+        patcher = mock.patch.dict(os.environ, {'HOME': home.name})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.anonymizer = pa.ProxyAnonymizer(Path(home.name) / "config.json")
+        self.addCleanup(self.anonymizer.store.close)
+
+    def test_preparation_starts_a_lead_time_before_the_rotation(self):
+        events = []
+        stop = threading.Event()
+        self.anonymizer.prepare_lead = 29.5  # Rotations are at least 30 seconds apart
+
+        def prepare_upstream():
+            events.append(('prepare', time.monotonic()))
+            return None, '203.0.113.1'
+
+        def wait(seconds, label):
+            if len([name for name, _ in events if name == 'swap']) >= 2:
+                stop.set()
+            else:
+                time.sleep(1)
+
+        self.anonymizer.prepare_upstream = prepare_upstream
+        self.anonymizer.switch_proxy = lambda proxy: events.append(('swap', time.monotonic()))
+        self.anonymizer.rotate(30, lambda ip: None, lambda e: None, wait, stop=stop)
+
+        names = [name for name, _ in events]
+        self.assertEqual(names[:4], ['prepare', 'swap', 'prepare', 'swap'])
+        swapped, prepared = events[1][1], events[2][1]
+        self.assertGreaterEqual(prepared - swapped, 0.4)
+
+    def test_early_rotation_prepares_at_once(self):
+        stop = threading.Event()
+        prepared = threading.Event()
+        self.anonymizer.prepare_upstream = lambda: (prepared.set(), (None, '203.0.113.1'))[1]
+        self.anonymizer.switch_proxy = lambda proxy: None
+
+        def wait(seconds, label):
+            prepared.clear()
+            self.anonymizer.rotate_now.set()
+            self.assertTrue(prepared.wait(5))
+            stop.set()
+
+        self.anonymizer.rotate(3600, lambda ip: None, lambda e: None, wait, stop=stop)
+
+if __name__ == '__main__':
+    unittest.main()
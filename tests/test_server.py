@@ -0,0 +1,32 @@
+import socket
+import sys
+import threading
+import unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import proxy_anonymizer as pa
+
+class SilentClientTest(unittest.TestCase):
+    """A client that connects and sends nothing is dropped after the handler timeout"""
+
+    def test_silent_client_is_closed(self):
+        switch = pa.UpstreamSwitch()
+        server = pa.ThreadedHTTPServer(
+            ('127.0.0.1', 0),
+            lambda *args, **kwargs: pa.ProxyHandler(*args, upstreams=switch, **kwargs)
+        )
+        server.socks_handler = lambda *args, **kwargs: pa.SocksHandler(*args, upstreams=switch, **kwargs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        with mock.patch.object(pa.ProxyHandler, 'timeout', 0.3):
+            with socket.create_connection(server.server_address, timeout=5) as client:
+                self.assertEqual(client.recv(1), b'')
+        self.assertEqual(server.connections, set())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import proxy_anonymizer as pa
+
+class SettingsTest(unittest.TestCase):
+    """Config file values keep their meaning or are skipped, never silently converted"""
+
+    def load(self, settings):
+        with tempfile.TemporaryDirectory() as home, mock.patch.dict(os.environ, {'HOME': home}):
+            config = Path(home) / "config.json"
+            config.write_text(json.dumps({"settings": settings}))
+            anonymizer = pa.ProxyAnonymizer(config)
+            anonymizer.store.close()
+            return anonymizer
+
+    def test_fractional_seconds_are_kept(self):
+        anonymizer = self.load({"upstream_connect_timeout": 0.5, "verify_timeout": 2.5, "breaker_cooldown": 0.5})
+        self.assertEqual(anonymizer.upstream_connect_timeout, 0.5)
+        self.assertEqual(anonymizer.verify_timeout, 2.5)
+        self.assertEqual(anonymizer.breaker_cooldown, 0.5)
+
+    def test_bools_are_parsed_strictly(self):
+        self.assertFalse(self.load({"sticky_hosts": "false"}).sticky_hosts)
+        self.assertTrue(self.load({"sticky_hosts": True}).sticky_hosts)
+        with self.assertLogs(level='WARNING'):
+            self.assertFalse(self.load({"sticky_hosts": "yes please"}).sticky_hosts)
+
+    def test_values_that_do_not_fit_are_skipped(self):
+        with self.assertLogs(level='WARNING'):
+            anonymizer = self.load({"local_port": 8080.5, "breaker_failures": "three", "verify_concurrency": 100})
+        self.assertEqual(anonymizer.local_port, 5005)
+        self.assertEqual(anonymizer.breaker_failures, 3)
+        self.assertEqual(anonymizer.verify_concurrency, 100)
+
+if __name__ == '__main__':
+    unittest.main()
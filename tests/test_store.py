@@ -0,0 +1,36 @@
+import sys
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import proxy_anonymizer as pa
+
+class ProxyStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.store = pa.ProxyStore(Path(self.dir.name) / "proxies.db")
+        self.addCleanup(self.store.close)
+
+    def count_checks(self) -> int:
+        return self.store.db.execute("SELECT COUNT(*) FROM checks").fetchone()[0]
+
+    def test_sync_prunes_old_history_once_an_interval(self):
+        """A long-running process keeps its check history bounded without restarting"""
+        proxy = pa.ProxyRecord('http', '192.0.2.1', 8080)
+        expired = time.time() - (self.store.HISTORY_DAYS + 1) * 86400
+        self.store.pending_checks.append((proxy.type, proxy.host, proxy.port, expired, 0, None))
+        self.store.sync(pa.ProxyPool(), None)
+        self.assertEqual(self.count_checks(), 1)
+
+        self.store.pruned_at -= self.store.PRUNE_INTERVAL
+        self.store.log_check(proxy, True, 0.2)
+        self.store.sync(pa.ProxyPool(), None)
+        self.assertEqual(self.count_checks(), 1)
+        self.assertEqual(self.store.db.execute("SELECT ok FROM checks").fetchone()[0], 1)
+
+if __name__ == '__main__':
+    unittest.main()
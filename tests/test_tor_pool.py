@@ -0,0 +1,41 @@
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import proxy_anonymizer as pa
+
+class TorPoolTest(unittest.TestCase):
+    """Tor lanes and instances are upstreams of their own"""
+
+    def setUp(self):
+        self.home = tempfile.TemporaryDirectory()
+        self.addCleanup(self.home.cleanup)
+        patcher = mock.patch.dict(os.environ, {'HOME': self.home.name})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_lanes_share_the_traffic(self):
+        anonymizer = pa.ProxyAnonymizer(Path(self.home.name) / "config.json")
+        self.addCleanup(anonymizer.store.close)
+        anonymizer.tor_pool = pa.TorPool(Path(self.home.name) / "tor", lanes=2)
+        anonymizer.tor_pool.start()
+        anonymizer.switch_proxy(anonymizer.tor_pool.circuits[0])
+
+        leased = [anonymizer.upstream_switch.acquire() for _ in range(2)]
+        self.assertEqual(sorted(upstream.proxy.lane for upstream in leased), [0, 1])
+
+    def test_missing_tor_binary_falls_back_to_the_system_tor(self):
+        pool = pa.TorPool(Path(self.home.name) / "tor", instances=2, lanes=2)
+        with mock.patch.dict(os.environ, {'PATH': self.home.name}), self.assertLogs(level='ERROR'):
+            pool.start()
+        self.assertEqual(pool.processes, [])
+        self.assertEqual({circuit.port for circuit in pool.circuits}, {9050})
+        self.assertEqual(len(pool.circuits), 2)
+
+if __name__ == '__main__':
+    unittest.main()
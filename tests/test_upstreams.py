@@ -0,0 +1,182 @@
+import http.server
+import socketserver
+import sys
+import threading
+import time
+import unittest
+from pathlib import Path
+
+import requests
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import proxy_anonymizer as pa
+
+class SlowBodyHandler(http.server.BaseHTTPRequestHandler):
+    """Sends the response head at once and the body after a pause"""
+
+    protocol_version = 'HTTP/1.1'
+    pause = 1.5
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '4')
+        self.end_headers()
+        self.wfile.flush()
+        time.sleep(self.pause)
+        self.wfile.write(b'done')
+
+    def log_message(self, *args):
+        pass
+
+def serve(server: socketserver.BaseServer) -> None:
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+class SlowBodyTest(unittest.TestCase):
+    """The response head has to arrive within header_timeout, the body may pause for longer"""
+
+    def setUp(self):
+        self.origin = socketserver.ThreadingTCPServer(('127.0.0.1', 0), SlowBodyHandler)
+        self.origin.daemon_threads = True
+        serve(self.origin)
+        self.addCleanup(self.origin.server_close)
+        self.addCleanup(self.origin.shutdown)
+
+        sessions = pa.UpstreamSessionPool()
+        self.switch = pa.UpstreamSwitch(sessions)
+        self.switch.header_timeout = 0.5
+        self.switch.swap_all([pa.Upstream(None, {'http': None, 'https': None})], None)
+        self.proxy = pa.ThreadedHTTPServer(
+            ('127.0.0.1', 0),
+            lambda *args, **kwargs: pa.ProxyHandler(*args, upstreams=self.switch, sessions=sessions, **kwargs)
+        )
+        serve(self.proxy)
+        self.addCleanup(self.proxy.server_close)
+        self.addCleanup(self.proxy.shutdown)
+
+    def test_slow_body_after_fast_head(self):
+        proxies = {'http': f'http://127.0.0.1:{self.proxy.server_address[1]}'}
+        with self.assertNoLogs(level='WARNING'):
+            response = requests.get(f'http://127.0.0.1:{self.origin.server_address[1]}/', proxies=proxies, timeout=10)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b'done')
+
+class UpstreamTest(unittest.TestCase):
+    def test_metrics_tell_tor_from_proxies(self):
+        circuit = pa.TorCircuit(9050, pa.TorController(), lane=0)
+        proxy = pa.ProxyRecord('socks5', '127.0.0.1', 1080)
+        self.assertEqual(pa.Upstream(None, {'http': 'socks5h://127.0.0.1:9050'}).kind, 'tor')
+        self.assertEqual(pa.Upstream(circuit, {'http': circuit.url}).kind, 'tor')
+        self.assertEqual(pa.Upstream(proxy, {'http': proxy.url}).kind, 'proxy')
+
+class CircuitBreakerTest(unittest.TestCase):
+    """Closed, open and half-open, with only the probe deciding how half-open ends"""
+
+    def setUp(self):
+        self.trips = []
+        self.breaker = pa.CircuitBreaker(failures=3, cooldown=0.2, on_trip=lambda: self.trips.append(1))
+
+    def fail(self, times: int = 1) -> bool:
+        tripped = False
+        for _ in range(times):
+            self.breaker.begin()
+            tripped = self.breaker.record(False, time.monotonic())
+        return tripped
+
+    def test_trips_after_the_failure_threshold(self):
+        self.assertFalse(self.fail(2))
+        self.assertEqual(self.breaker.state, 'closed')
+        self.assertTrue(self.fail())
+        self.assertEqual(self.breaker.state, 'open')
+        self.assertFalse(self.breaker.ready())
+        self.assertEqual(len(self.trips), 1)
+
+    def test_success_resets_the_streak(self):
+        self.fail(2)
+        self.breaker.record(True, time.monotonic())
+        self.assertFalse(self.fail(2))
+        self.assertEqual(self.breaker.state, 'closed')
+
+    def test_single_probe_after_the_cooldown(self):
+        self.fail(3)
+        time.sleep(0.25)
+        self.assertTrue(self.breaker.ready())
+        self.breaker.begin()
+        started = time.monotonic()
+        self.assertEqual(self.breaker.state, 'half_open')
+        # Nothing else goes through while the probe is out
+        self.assertFalse(self.breaker.ready())
+        self.breaker.record(True, started)
+        self.assertEqual(self.breaker.state, 'closed')
+        self.assertTrue(self.breaker.ready())
+
+    def test_failed_probe_opens_again(self):
+        self.fail(3)
+        time.sleep(0.25)
+        self.breaker.begin()
+        self.assertTrue(self.breaker.record(False, time.monotonic()))
+        self.assertEqual(self.breaker.state, 'open')
+        self.assertFalse(self.breaker.ready())
+        self.assertEqual(len(self.trips), 2)
+
+    def test_late_results_from_before_the_trip_are_ignored(self):
+        sent_before_trip = time.monotonic()
+        self.fail(3)
+        self.assertFalse(self.breaker.record(True, sent_before_trip))
+        self.assertEqual(self.breaker.state, 'open')
+        time.sleep(0.25)
+        self.breaker.begin()
+        self.assertFalse(self.breaker.record(True, sent_before_trip))
+        self.assertFalse(self.breaker.record(False, sent_before_trip))
+        self.assertEqual(self.breaker.state, 'half_open')
+        self.assertEqual(len(self.trips), 1)
+
+class FailoverTest(unittest.TestCase):
+    """Retries move to other upstreams but share the request's deadline"""
+
+    def setUp(self):
+        self.switch = pa.UpstreamSwitch()
+        self.upstreams = [pa.Upstream(None, {'http': f'http://127.0.0.1:{port}'}) for port in (1, 2, 3)]
+        self.switch.swap_all(self.upstreams, None)
+
+    def test_retries_on_another_upstream(self):
+        tried = []
+
+        def attempt(upstream, deadline):
+            tried.append(upstream)
+            if len(tried) == 1:
+                raise ConnectionError("refused")
+            return 'ok'
+
+        upstream, result = self.switch.failover(None, attempt)
+        self.assertEqual(result, 'ok')
+        self.assertIs(upstream, tried[1])
+        self.assertIsNot(tried[0], tried[1])
+        self.switch.release(upstream)
+
+    def test_attempts_share_one_deadline(self):
+        self.switch.request_timeout = 0.3
+        deadlines = []
+
+        def attempt(upstream, deadline):
+            deadlines.append(deadline)
+            time.sleep(0.2)
+            raise TimeoutError("no answer")
+
+        started = time.monotonic()
+        with self.assertRaises(TimeoutError):
+            self.switch.failover(None, attempt)
+        # Three attempts are allowed, but the deadline has passed after the second
+        self.assertEqual(len(deadlines), 2)
+        self.assertEqual(len(set(deadlines)), 1)
+        self.assertAlmostEqual(deadlines[0], started + 0.3, delta=0.05)
+        self.assertEqual([upstream.active for upstream in self.upstreams], [0, 0, 0])
+
+    def test_time_left_never_passes_the_deadline(self):
+        deadline = time.monotonic() + 1
+        self.assertLessEqual(self.switch.time_left(deadline, 5), 1)
+        self.assertEqual(self.switch.time_left(deadline, 0.5), 0.5)
+        self.assertEqual(self.switch.time_left(time.monotonic() - 1, 5), 0.01)
+
+if __name__ == '__main__':
+    unittest.main()